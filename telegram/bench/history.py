@@ -0,0 +1,67 @@
+# telegram/bench/history.py
+# Микробенчмарк загрузки истории диалога (Request.get_client_history)
+#
+# Запуск из каталога telegram (нужна тестовая БД из .env):
+#   python -m bench.history
+#
+# Для временного клиента наращивается история rec_dialog до 20 000 строк,
+# на каждом шаге замеряется время get_client_history. При выборке окна
+# через LIMIT время не должно расти вместе с объёмом истории.
+
+import asyncio
+import statistics
+import time
+import uuid
+
+from classes.env import Env
+from classes.log import Log
+from classes.mysql import MySQL
+from classes.request import Request
+
+SIZES = [100, 1000, 5000, 10000, 20000]
+REPEAT = 50
+
+class Bench:
+    def __init__(self):
+        self.env = Env()
+        self.log = Log()
+        self.mysql = MySQL(self)
+        self.request = Request(self)
+
+async def fill(bench, client_id, start, stop):
+    sql = "INSERT INTO rec_dialog (client_id, role, content) VALUES (%s, %s, %s)"
+    rows = [(client_id, i % 2, f'сообщение {i} ' + 'x' * 200) for i in range(start, stop)]
+    async with bench.mysql.transaction() as tx:
+        for i in range(0, len(rows), 1000):
+            await tx.executemany(sql, rows[i:i + 1000])
+
+async def main():
+    bench = Bench()
+    tel_id = 'bench-' + uuid.uuid4().hex[:12]
+    client_id = await bench.request.get_or_create_client_id(tel_id)
+
+    try:
+        print(f'{"rows":>8} {"p50, ms":>10} {"p95, ms":>10}')
+        current = 0
+        for size in SIZES:
+            await fill(bench, client_id, current, size)
+            current = size
+
+            timings = []
+            for _ in range(REPEAT):
+                # замеряем чтение из БД, а не из кэша контекстов
+                bench.request.contexts.clear()
+                started = time.perf_counter()
+                await bench.request.get_client_history(client_id)
+                timings.append((time.perf_counter() - started) * 1000)
+            timings.sort()
+            p50 = statistics.median(timings)
+            p95 = timings[int(len(timings) * 0.95) - 1]
+            print(f'{size:>8} {p50:>10.2f} {p95:>10.2f}')
+    finally:
+        await bench.mysql.execute("DELETE FROM rec_dialog WHERE client_id = %s", (client_id,))
+        await bench.mysql.execute("DELETE FROM rec_client WHERE id = %s", (client_id,))
+        await bench.mysql.shutdown()
+
+if __name__ == '__main__':
+    asyncio.run(main())
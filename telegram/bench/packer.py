@@ -0,0 +1,130 @@
+# telegram/bench/packer.py
+# Бенчмарк упаковки контекста в бюджет токенов (Request.build_messages)
+#
+# Запуск из каталога telegram (нужна БД с записанными диалогами и ключ OpenAI для чанков):
+#   python -m bench.packer [бюджет]
+#
+# Для последних ответов ассистента из rec_dialog восстанавливается промпт:
+# system.md, справочные данные, записи на приём, окно истории до сообщения
+# пользователя и чанки по этому сообщению. Сравнивается среднее число
+# токенов промпта без бюджета и с бюджетом (по умолчанию PROMPT_TOKEN_BUDGET),
+# рядом выводится среднее записанное tokens_in.
+
+import asyncio
+import statistics
+import sys
+
+from classes.env import Env
+from classes.log import Log
+from classes.mysql import MySQL
+from classes.reference import Reference
+from classes.chunks import Chunks
+from classes.gpt import Gpt
+from classes.request import Request
+
+SAMPLE = 200
+DEFAULT_BUDGET = 4000
+
+class Bench:
+    def __init__(self):
+        self.env = Env()
+        self.log = Log()
+        self.mysql = MySQL(self)
+        self.reference = Reference(self)
+        self.chunks = Chunks(self)
+        self.gpt = Gpt(self)
+        self.request = Request(self)
+
+async def load_turns(bench):
+    """
+    Последние ответы ассистента с записанным tokens_in и предшествующий им диалог.
+    """
+    sql = """
+        SELECT id, client_id, tokens_in FROM rec_dialog
+        WHERE role = 1 AND tokens_in > 0 AND is_delete = 0
+        ORDER BY id DESC
+        LIMIT %s
+    """
+    answers = await bench.mysql.fetch_all(sql, (SAMPLE,))
+
+    sql_before = """
+        SELECT role, content FROM rec_dialog
+        WHERE client_id = %s AND id < %s AND is_delete = 0
+        ORDER BY id DESC
+        LIMIT %s
+    """
+    role_map = {0: "user", 1: "assistant"}
+    extract = bench.request.history_limit()
+    turns = []
+    for answer_id, client_id, tokens_in in answers:
+        rows = await bench.mysql.fetch_all(sql_before, (client_id, answer_id, extract + 1))
+        rows = list(rows[::-1])
+        if not rows or rows[-1][0] != 0:
+            continue
+        user_input = rows[-1][1]
+        history = [{"role": role_map.get(r[0], "user"), "content": r[1]} for r in rows[:-1]]
+        hist_summary, hist_dialog = (history[:2], history[2:]) if len(history) >= extract else ([], history)
+        turns.append((client_id, tokens_in, user_input, hist_dialog, hist_summary))
+    return turns
+
+async def main():
+    bench = Bench()
+    request = bench.request
+    packer = request.get_packer()
+    budget = int(sys.argv[1]) if len(sys.argv) > 1 else (bench.env.get_int('PROMPT_TOKEN_BUDGET') or DEFAULT_BUDGET)
+
+    try:
+        turns = await load_turns(bench)
+        if not turns:
+            print('В rec_dialog нет записанных ответов с tokens_in')
+            return
+
+        system = await request.get_system_prompt()
+        if bench.env.get_int('PROMPT_REFERENCE'):
+            data = [{"role": "assistant", "content": await bench.reference.get_fragment()}]
+        else:
+            data = request.get_demo_data()
+
+        recorded, full, packed, cut = [], [], [], 0
+        for client_id, tokens_in, user_input, hist_dialog, hist_summary in turns:
+            write_me = await request.get_write_recept(client_id)
+            write_friends = await request.get_write_recept_friends(client_id)
+            bookings = [
+                {'role': 'assistant', 'content': f'Вы записаны на прием:\n{write_me}' if write_me else 'Вы пока не записаны на прием!'},
+                {'role': 'user', 'content': 'Кто-то из моих друзей, родственников, знакомых записаны на прием?'},
+                {'role': 'assistant', 'content': f'Вами записаны на прием:\n{write_friends}' if write_friends else 'Вами никто не записан на прием!'},
+                {'role': 'user', 'content': 'Понял'}
+            ]
+            hist_summary_str = "\n".join(f"{m['role']}: {m['content']}" for m in hist_summary)
+            turn = (
+                "🕒 Текущая дата и время: 2000-01-01 00:00:00"
+                f"\n\n📌 Текущая информаци для summary:\n{await request.get_user_summary(client_id)}\n\n"
+                f"📌 Последняя пара сообщений для включения в summary:\n{hist_summary_str}"
+            )
+            user_content = f"Ответь строго в JSON формате. Вот сообщение пользователя: {user_input}\n\nКонтекст из базы знаний (чанки): "
+            chunks = await bench.chunks.find_local_list(user_input)
+
+            args = (system, data, bookings, hist_dialog, turn, user_content, chunks)
+            messages, _ = request.build_messages(*args)
+            messages_packed, report = request.build_messages(*args, budget)
+
+            recorded.append(tokens_in)
+            full.append(packer.count_messages(messages) + packer.REPLY_OVERHEAD)
+            packed.append(packer.count_messages(messages_packed) + packer.REPLY_OVERHEAD)
+            cut += bool(report['cut'])
+
+        avg_full = statistics.mean(full)
+        avg_packed = statistics.mean(packed)
+        print(f'диалогов: {len(turns)}, бюджет: {budget}, сокращено: {cut}')
+        print(f'{"":>22} {"среднее":>10} {"max":>8}')
+        print(f'{"tokens_in (записано)":>22} {statistics.mean(recorded):>10.0f} {max(recorded):>8}')
+        print(f'{"без бюджета":>22} {avg_full:>10.0f} {max(full):>8}')
+        print(f'{"с бюджетом":>22} {avg_packed:>10.0f} {max(packed):>8}')
+        print(f'снижение: {(1 - avg_packed / avg_full) * 100:.1f}%')
+    finally:
+        await bench.reference.shutdown()
+        await bench.gpt.shutdown()
+        await bench.mysql.shutdown()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,72 @@
+# telegram/bench/retrieval.py
+# Бенчмарк одновременных поисков по базе знаний (Chunks.find_local_list)
+#
+# Запуск из каталога telegram (нужны индекс base/base08.faiss и ключ OpenAI):
+#   python -m bench.retrieval
+#
+# Для каждого уровня параллельности запускаются одновременные поиски по разным
+# вопросам без пачек и с пачками (RETRIEVAL_BATCH). Кэш эмбеддингов отключается,
+# чтобы каждый поиск запрашивал эмбеддинг. Выводятся пропускная способность
+# и число запросов эмбеддингов к OpenAI.
+
+import asyncio
+import time
+import uuid
+
+from classes.env import Env
+from classes.log import Log
+from classes.chunks import Chunks
+from classes.gpt import Gpt
+from classes.batcher import MicroBatcher
+
+CONCURRENCY = [1, 8, 32, 64]
+QUESTIONS = [
+    'Где находится центр?',
+    'Сколько стоит лечение?',
+    'Какой врач принимает?',
+    'Помогаете ли вы при болях в спине?',
+    'Нужно ли обследование перед приёмом?',
+    'Сколько длится приём?'
+]
+
+class Bench:
+    def __init__(self):
+        self.env = Env()
+        self.log = Log()
+        self.gpt = Gpt(self)
+        self.chunks = Chunks(self)
+
+async def run(bench, concurrency: int, batch: bool):
+    chunks = bench.chunks
+    chunks.embeddings.path = ''
+    chunks.embeddings.memory.clear()
+    if batch:
+        chunks.embed_batcher = MicroBatcher(chunks.embed_batch, 0.005, 32)
+        chunks.search_batcher = MicroBatcher(chunks.search_batch, 0.005, 32)
+    else:
+        chunks.embed_batcher = chunks.search_batcher = None
+
+    # уникальный суффикс - чтобы вопросы не совпадали между прогонами
+    tag = uuid.uuid4().hex[:6]
+    questions = [f'{QUESTIONS[i % len(QUESTIONS)]} ({tag}-{i})' for i in range(concurrency)]
+    started = time.perf_counter()
+    await asyncio.gather(*(chunks.find_local_list(q) for q in questions))
+    elapsed = time.perf_counter() - started
+    requests = chunks.embed_batcher.batches if batch else concurrency
+    return concurrency / elapsed, requests
+
+async def main():
+    bench = Bench()
+    await bench.chunks.get_index()
+    try:
+        print(f'{"concurrency":>12} {"qps":>8} {"qps batch":>10} {"embed req":>10} {"embed req batch":>16}')
+        for concurrency in CONCURRENCY:
+            qps, requests = await run(bench, concurrency, False)
+            qps_batch, requests_batch = await run(bench, concurrency, True)
+            print(f'{concurrency:>12} {qps:>8.1f} {qps_batch:>10.1f} {requests:>10} {requests_batch:>16}')
+    finally:
+        await bench.chunks.shutdown()
+        await bench.gpt.shutdown()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+# telegram/classes/answers.py
+# Семантический кэш ответов на вопросы по базе знаний
+
+import os
+import re
+import numpy as np
+from classes.cache import LRUCache
+
+class AnswerCache:
+    """
+    Ответы модели на общие вопросы («где вы находитесь», «сколько стоит»),
+    найденные по близости эмбеддинга вопроса (косинусное сходство не ниже порога).
+    Записи ограничены числом (LRU) и временем жизни. Кэш полностью сбрасывается
+    при изменении system.md, индекса FAISS или справочников.
+    """
+
+    def __init__(self, main):
+        self.main = main
+        self.enabled = bool(self.main.env.get_int('ANSWER_CACHE'))
+        self.threshold = self.main.env.get_float('ANSWER_CACHE_THRESHOLD', 0.95)
+        self.min_chars = self.main.env.get_int('ANSWER_CACHE_MIN_CHARS', 10)
+        self.entries = LRUCache(
+            self.main.env.get_int('ANSWER_CACHE_SIZE', 1000),
+            ttl=self.main.env.get_float('ANSWER_CACHE_TTL', 3600.0)
+        )
+
+        # матрица нормированных эмбеддингов для поиска (пересобирается после изменений)
+        self._keys = []
+        self._matrix = None
+        self._dirty = False
+
+        self.version = None
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        return re.sub(r'\s+', ' ', question.strip().lower())
+
+    @staticmethod
+    def unit(vector):
+        vector = np.array(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def eligible(self, question: str, personal: bool) -> bool:
+        """
+        Кэш применяется только к достаточно длинным вопросам и не к клиентам с записями на приём
+        (`personal`). Короткие «да», номер времени и т.п. зависят от контекста диалога.
+        Сохранять ответ можно, только если в промпте не было summary и сообщений клиента:
+        иначе ответ может упоминать его имя или жалобы и попасть к другим (см. Request.handle_message).
+        """
+        return self.enabled and not personal and len(self.normalize(question)) >= self.min_chars
+
+    def get_version(self):
+        """
+        Отметка источников ответа: system.md, файлы индекса FAISS, справочники.
+        """
+        paths = [self.main.request.system_path]
+        index_path = self.main.chunks.index_path
+        if os.path.isdir(index_path):
+            paths += [entry.path for entry in os.scandir(index_path)]
+        stamps = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                stamps.append((str(path), stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                stamps.append((str(path), None, None))
+        return tuple(sorted(stamps)), self.main.reference.stamp, self.main.reference.day
+
+    def check_version(self):
+        version = self.get_version()
+        if version != self.version:
+            if self.version is not None and len(self.entries):
+                self.invalidations += 1
+            self.version = version
+            self.clear()
+
+    def clear(self):
+        self.entries.clear()
+        self._keys = []
+        self._matrix = None
+        self._dirty = False
+
+    def _rebuild(self):
+        items = [(key, self.entries.peek(key)) for key in self.entries.keys()]
+        items = [(key, value) for key, value in items if value is not None]
+        self._keys = [key for key, _ in items]
+        self._matrix = np.vstack([value[0] for _, value in items]) if items else None
+        self._dirty = False
+
+    def lookup(self, question: str, vector):
+        """
+        Возвращает (ответ, сходство) для самого близкого сохранённого вопроса или (None, сходство).
+        """
+        self.check_version()
+        if self._dirty:
+            self._rebuild()
+        if self._matrix is None or vector is None:
+            self.entries.misses += 1
+            return None, 0.0
+
+        query = self.unit(vector)
+        scores = self._matrix @ query
+        best = int(np.argmax(scores))
+        score = float(scores[best])
+        if score < self.threshold:
+            self.entries.misses += 1
+            return None, score
+
+        value = self.entries.get(self._keys[best])
+        if value is None:
+            # запись устарела или вытеснена
+            self._dirty = True
+            return None, score
+        return value[1], score
+
+    def store(self, question: str, vector, answer: str):
+        if vector is None:
+            return
+        self.check_version()
+        query = self.unit(vector)
+        self.entries.set(self.normalize(question), (query, answer))
+        self._dirty = True
+
+    def stats(self) -> dict:
+        return {**self.entries.stats(), 'enabled': self.enabled, 'invalidations': self.invalidations}
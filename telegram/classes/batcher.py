@@ -0,0 +1,66 @@
+# telegram/classes/batcher.py
+# Объединение одновременных запросов в пачки (micro-batching)
+
+import asyncio
+
+class MicroBatcher:
+    """
+    Собирает элементы, поступившие в течение `window` секунд (но не больше `max_size`),
+    и обрабатывает их одним вызовом `process(items) -> results`.
+    Каждый вызывающий получает свой результат; ошибка пачки передаётся всем её участникам.
+    """
+
+    def __init__(self, process, window: float = 0.005, max_size: int = 32):
+        self.process = process
+        self.window = window
+        self.max_size = max_size
+        self.queue = []             # [(элемент, future)]
+        self._timer = None
+        self._tasks = set()
+
+        self.batches = 0
+        self.items = 0
+        self.max_batch = 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.queue.append((item, future))
+        if len(self.queue) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self.queue = self.queue, []
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        self.batches += 1
+        self.items += len(batch)
+        self.max_batch = max(self.max_batch, len(batch))
+        try:
+            results = await self.process([item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'avg_batch': round(self.items / self.batches, 2) if self.batches else 0.0,
+            'max_batch': self.max_batch
+        }
@@ -0,0 +1,123 @@
+# telegram/classes/cache.py
+# Ограниченный LRU-кэш в памяти процесса
+
+import time
+from collections import OrderedDict
+
+class LRUCache:
+    """
+    Кэш «ключ → значение» с вытеснением давно не использованных записей.
+    Дополнительно можно ограничить время жизни записи (`ttl`, сек) и суммарный
+    объём (`maxbytes`, оценивается функцией `sizeof`).
+    Считает попадания, промахи, вытеснения и устаревшие записи.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = None, maxbytes: int = None, sizeof=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self._data = OrderedDict()     # ключ → (значение, время записи, размер)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key, default=None):
+        """
+        Возвращает значение по ключу и помечает запись как недавно использованную.
+        """
+        item = self._data.get(key)
+        if item is not None:
+            value, stored, _ = item
+            if self.ttl is None or time.monotonic() - stored < self.ttl:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            self.pop(key)
+            self.expired += 1
+        self.misses += 1
+        return default
+
+    def peek(self, key, default=None):
+        """
+        Возвращает актуальное значение без учёта в счётчиках и без изменения порядка.
+        """
+        item = self._data.get(key)
+        if item is None or (self.ttl is not None and time.monotonic() - item[1] >= self.ttl):
+            return default
+        return item[0]
+
+    def set(self, key, value):
+        """
+        Добавляет или обновляет запись, вытесняя самые старые при переполнении.
+        """
+        self.pop(key)
+        size = self.sizeof(value) if self.sizeof else 0
+        self._data[key] = (value, time.monotonic(), size)
+        self.bytes += size
+        self._evict()
+
+    def update(self, key):
+        """
+        Пересчитывает размер записи после изменения значения на месте
+        и вытесняет самые старые записи, если объём превышен.
+        Время записи (для ttl) не меняется.
+        """
+        item = self._data.get(key)
+        if item is None or not self.sizeof:
+            return
+        value, stored, size = item
+        new_size = self.sizeof(value)
+        self._data[key] = (value, stored, new_size)
+        self.bytes += new_size - size
+        self._evict()
+
+    def _evict(self):
+        while self._data and (
+            len(self._data) > self.maxsize
+            or (self.maxbytes is not None and self.bytes > self.maxbytes)
+        ):
+            _, (_, _, old_size) = self._data.popitem(last=False)
+            self.bytes -= old_size
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self.bytes -= item[2]
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def keys(self) -> list:
+        """
+        Ключи в порядке от давно использованных к недавним (без учёта в счётчиках).
+        """
+        return list(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self) -> dict:
+        """
+        Возвращает счётчики кэша.
+        """
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expired': self.expired,
+            'hit_ratio': round(self.hits / total, 4) if total else 0.0
+        }
@@ -5,8 +5,11 @@ import os
 from langchain.text_splitter import MarkdownHeaderTextSplitter
 from openai import OpenAI
 from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
 import asyncio
+import time
+import numpy as np
+from classes.embeddings import EmbeddingCache
+from classes.batcher import MicroBatcher
 
 class Chunks:
 
@@ -22,28 +25,205 @@ class Chunks:
         self.main = main
 
         # инициализация локального индекса
+        self.index_path = 'base/base08.faiss'
         self.local_index = None        
 
+        # загрузка индекса: один раз, запросы до готовности ждут на блокировке
+        self._lock = asyncio.Lock()
+        self.loading_task = None
+        self.load_stats = {}
+
+        # проверка обновления индекса на диске (сек, 0 - не проверять)
+        self.reload_interval = self.main.env.get_float('INDEX_RELOAD_INTERVAL', 60.0)
+        self.reload_task = None
+        self.checked_at = 0.0
+        self.stamp = None
+
+        # кэш эмбеддингов вопросов (память + диск)
+        self.embeddings = EmbeddingCache(main)
+
+        # объединение одновременных запросов: один запрос эмбеддингов и один поиск на пачку
+        # (включается RETRIEVAL_BATCH=1)
+        self.k = 5
+        self.embed_batcher = self.search_batcher = None
+        if self.main.env.get_int('RETRIEVAL_BATCH'):
+            window = self.main.env.get_float('RETRIEVAL_BATCH_WINDOW_MS', 5.0) / 1000
+            size = self.main.env.get_int('RETRIEVAL_BATCH_SIZE', 32)
+            self.embed_batcher = MicroBatcher(self.embed_batch, window, size)
+            self.search_batcher = MicroBatcher(self.search_batch, window, size)
+
+    # МЕТОД: фоновая загрузка и прогрев индекса при старте бота
+    def start(self):
+        """
+        Запускает загрузку индекса в фоне, не задерживая приём сообщений.
+        """
+        if self.loading_task is None:
+            self.loading_task = asyncio.create_task(self.warm_up())
+
+    async def warm_up(self):
+        try:
+            await self.get_index()
+        except Exception as e:
+            await self.main.log.log_info('chunks', 'Ошибка загрузки индекса', str(e), True)
+
+    # МЕТОД: индекс базы знаний (загружается при первом обращении, повторно не загружается)
+    async def get_index(self):
+        """
+        Возвращает загруженный индекс. Пока индекс загружается, вызовы ждут его готовности.
+        Если файл индекса на диске обновлён (classes.indexer), новый индекс загружается
+        в фоне, а до готовности используется прежний.
+        """
+        if self.local_index is None:
+            async with self._lock:
+                if self.local_index is None:
+                    await self.load()
+        elif self.reload_interval and time.monotonic() - self.checked_at >= self.reload_interval:
+            self.checked_at = time.monotonic()
+            if self.get_stamp() != self.stamp and not self._lock.locked():
+                self.reload_task = asyncio.create_task(self.reload())
+        return self.local_index
+
+    def get_stamp(self):
+        try:
+            return tuple(
+                os.stat(os.path.join(self.index_path, name)).st_mtime_ns
+                for name in ('index.faiss', 'index.pkl')
+            )
+        except OSError:
+            return None
+
+    async def load(self, attempts: int = 3):
+        """
+        Загружает индекс. Если файлы индекса заменялись во время загрузки (Indexer.save
+        переносит их по одному), загрузка повторяется, чтобы не получить векторы
+        и docstore от разных версий.
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(attempts):
+            stamp = self.get_stamp()
+            index, stats = await loop.run_in_executor(
+                None, self.load_index, self.main.gpt.get_embeddings()
+            )
+            if self.get_stamp() == stamp:
+                break
+            if attempt < attempts - 1:
+                await asyncio.sleep(0.5)
+        self.local_index, self.load_stats = index, stats
+        self.stamp = stamp
+        self.checked_at = time.monotonic()
+        await self.main.log.log_info('chunks', 'Индекс базы знаний загружен', self.load_stats, True)
+
+    async def reload(self):
+        try:
+            async with self._lock:
+                await self.load()
+        except Exception as e:
+            await self.main.log.log_info('chunks', 'Ошибка перезагрузки индекса', str(e), True)
+
+    def load_index(self, embeddings):
+        """
+        Загрузка индекса и пробный поиск (выполняется вне цикла событий).
+        """
+        started = time.perf_counter()
+        index = FAISS.load_local(
+            self.index_path,
+            embeddings,
+            allow_dangerous_deserialization=True
+        )
+        loaded = time.perf_counter()
+
+        # прогрев: поиск нулевым вектором, без запроса эмбеддинга
+        index.index.search(np.zeros((1, index.index.d), dtype=np.float32), 1)
+        warmed = time.perf_counter()
+
+        stats = {
+            'load_ms': round((loaded - started) * 1000, 1),
+            'warmup_ms': round((warmed - loaded) * 1000, 1),
+            'vectors': index.index.ntotal,
+            'dim': index.index.d,
+            'index_mb': round(os.path.getsize(os.path.join(self.index_path, 'index.faiss')) / 1024 / 1024, 2),
+            'docstore_mb': round(os.path.getsize(os.path.join(self.index_path, 'index.pkl')) / 1024 / 1024, 2)
+        }
+        return index, stats
+
     # МЕТОД: поиск в локальной индексной базе знаний
     #   question - вопрос к базе знаний
     async def find_local(self, question: str) -> str:
         """
         Асинхронный метод поиска в локальной базе знаний с использованием FAISS.
         """
+        return "\n\n".join(await self.find_local_list(question))
+
+    # МЕТОД: эмбеддинг вопроса (общий для поиска чанков и кэша ответов)
+    #   question - вопрос к базе знаний
+    async def embed_query(self, question: str):
+        """
+        Эмбеддинг нормализованного текста вопроса: из кэша или запросом к OpenAI.
+        """
+        text = EmbeddingCache.normalize(question)
+        embeddings = self.main.gpt.get_embeddings()
+        vector = await self.embeddings.get(embeddings.model, text)
+        if vector is None:
+            if self.embed_batcher:
+                vector = await self.embed_batcher.submit(text)
+            else:
+                vector = await embeddings.aembed_query(text)
+            await self.embeddings.put(embeddings.model, text, vector)
+        return vector
+
+    async def embed_batch(self, texts: list) -> list:
+        """
+        Эмбеддинги пачки вопросов одним запросом (повторяющиеся тексты - один раз).
+        """
+        unique = list(dict.fromkeys(texts))
+        vectors = await self.main.gpt.get_embeddings().aembed_documents(unique)
+        by_text = dict(zip(unique, vectors))
+        return [by_text[text] for text in texts]
+
+    async def search_batch(self, vectors: list) -> list:
+        """
+        Поиск чанков для пачки эмбеддингов одним index.search по общей матрице.
+        """
+        index = await self.get_index()
+
+        def search():
+            matrix = np.vstack([np.asarray(vector, dtype=np.float32) for vector in vectors])
+            if getattr(index, '_normalize_L2', False):
+                matrix /= np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+            _, ids = index.index.search(matrix, self.k)
+            return [
+                [index.docstore.search(index.index_to_docstore_id[i]).page_content for i in row if i != -1]
+                for row in ids
+            ]
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, search)
+
+    # МЕТОД: освобождение ресурсов
+    async def shutdown(self):
+        await self.embeddings.shutdown()
+
+    # МЕТОД: поиск в локальной индексной базе знаний (список чанков по убыванию релевантности)
+    #   question - вопрос к базе знаний
+    #   vector - готовый эмбеддинг вопроса (если уже вычислен)
+    async def find_local_list(self, question: str, vector: list = None) -> list:
+        """
+        Асинхронный поиск в локальной базе знаний, возвращает тексты чанков списком.
+        """
 
-        def load_and_search():
-            os.environ['OPENAI_API_KEY'] = self.main.env.get('OPENAI_API_KEY')
+        # эмбеддинг вопроса вычисляется параллельно с ожиданием готовности индекса
+        if vector is None:
+            index, vector = await asyncio.gather(self.get_index(), self.embed_query(question))
+        else:
+            index = await self.get_index()
 
-            if self.local_index is None:
-                self.local_index = FAISS.load_local(
-                    'base/base08.faiss',
-                    OpenAIEmbeddings(),
-                    allow_dangerous_deserialization=True
-                )
+        if self.search_batcher:
+            return await self.search_batcher.submit(vector)
 
-            results = self.local_index.similarity_search(question, k=5)
-            return "\n\n".join(doc.page_content for doc in results)
+        def search():
+            results = index.similarity_search_by_vector(vector, k=self.k)
+            return [doc.page_content for doc in results]
 
         loop = asyncio.get_running_loop()
-        context = await loop.run_in_executor(None, load_and_search)
-        return context
\ No newline at end of file
+        context = await loop.run_in_executor(None, search)
+        return context
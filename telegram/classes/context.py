@@ -0,0 +1,48 @@
+# telegram/classes/context.py
+# Контекст диалога клиента, кэшируемый в памяти между сообщениями
+
+import sys
+from datetime import date
+
+class ClientContext:
+    """
+    Данные клиента, которые нужны для сборки промпта.
+    Поле со значением None ещё не загружено из БД.
+    """
+
+    def __init__(self, client_id: int):
+        self.client_id = client_id
+        self.day = date.today()         # контекст действителен в пределах одних суток
+        self.summary = None             # rec_client.summary
+        self.history = None             # последние сообщения [(role, content), ...]
+        self.write_me = None            # записи клиента (get_write_recept)
+        self.write_friends = None       # записи друзей (get_write_recept_friends)
+
+    def add_message(self, role: int, content: str, limit: int):
+        """
+        Дописывает сообщение в окно истории (если оно загружено).
+        """
+        if self.history is not None:
+            self.history.append((role, content))
+            del self.history[:-limit]
+
+    def clear_dialog(self):
+        self.history = []
+        self.summary = ''
+
+    def clear_bookings(self):
+        self.write_me = None
+        self.write_friends = None
+
+    @staticmethod
+    def size(ctx) -> int:
+        """
+        Приблизительный объём контекста в байтах (для ограничения памяти кэша).
+        """
+        total = sys.getsizeof(ctx) + sys.getsizeof(ctx.summary or '')
+        for _, content in ctx.history or []:
+            total += sys.getsizeof(content) + 64
+        for rows in (ctx.write_me, ctx.write_friends):
+            for row in rows or []:
+                total += sum(sys.getsizeof(v) for v in row.values()) + 232
+        return total
@@ -0,0 +1,166 @@
+# telegram/classes/dialog.py
+# Отложенная (write-behind) запись сообщений диалога в rec_dialog
+
+import asyncio
+from datetime import datetime
+from itertools import groupby
+
+class DialogWriter:
+    """
+    Буфер сообщений диалога.
+    Сообщения копятся в памяти и записываются в `rec_dialog` многострочными INSERT,
+    когда набирается DIALOG_BATCH_SIZE строк или проходит DIALOG_BATCH_INTERVAL секунд.
+    Незаписанные строки доступны для чтения через `pending()`.
+    """
+
+    def __init__(self, main):
+        self.main = main
+        self.batch_size = self.main.env.get_int('DIALOG_BATCH_SIZE', 50)
+        self.interval = self.main.env.get_float('DIALOG_BATCH_INTERVAL', 1.0)
+
+        # есть ли столбец rec_dialog.tokens_cached (миграция 2), задаётся Request.check_schema
+        self.tokens_cached = True
+
+        self._rows = []         # ожидают записи
+        self._inflight = []     # записываются прямо сейчас
+        self._lock = asyncio.Lock()
+        self._full = asyncio.Event()
+
+        # счётчик успешных сбросов (для согласованного чтения)
+        self.generation = 0
+
+        self.processing_task = None  # фоновая задача сброса
+
+    async def add(self, client_id: int, role: int, content: str,
+                  tokens_in: int = 0, tokens_out: int = 0, tokens_cached: int = 0,
+                  price_in: float = None, price_out: float = None):
+        """
+        Ставит сообщение в очередь на запись.
+        """
+        self._rows.append({
+            'client_id': client_id,
+            'role': role,
+            'content': content,
+            'tokens_in': tokens_in,
+            'tokens_out': tokens_out,
+            'tokens_cached': tokens_cached,
+            'price_in': price_in,
+            'price_out': price_out,
+            'time': datetime.now()
+        })
+
+        # Если задача еще не запущена, запускаем её
+        if not self.processing_task:
+            self.processing_task = asyncio.create_task(self._process())
+
+        if len(self._rows) >= self.batch_size:
+            self._full.set()
+
+    def pending(self, client_id: int) -> list:
+        """
+        Возвращает ещё не записанные в БД сообщения клиента в хронологическом порядке.
+        """
+        return [r for r in self._inflight + self._rows if r['client_id'] == client_id]
+
+    async def read(self, client_id: int, loader):
+        """
+        Согласованное чтение: выполняет `loader()` (запрос к БД) и возвращает
+        (результат, незаписанные сообщения клиента) так, чтобы одна и та же строка
+        не попала одновременно и в результат, и в буфер.
+        Пока идёт сброс, записываемые строки могут быть уже видны в БД и ещё лежать
+        в буфере, поэтому чтение ждёт его окончания и повторяется, если сброс начался
+        или закончился во время запроса.
+        """
+        while True:
+            if self._inflight:
+                async with self._lock:
+                    pass
+                continue
+            generation = self.generation
+            pending = self.pending(client_id)
+            result = await loader()
+            if generation == self.generation and not self._inflight:
+                return result, pending
+
+    async def _process(self):
+        """Фоновая корутина: сбрасывает буфер по размеру или по таймеру"""
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+
+            try:
+                await self.flush()
+            except Exception as e:
+                await self.main.log.log_info('mysql', 'Ошибка записи диалога', str(e), True)
+
+    async def flush(self):
+        """
+        Записывает все накопленные сообщения одной транзакцией.
+        При ошибке строки возвращаются в буфер для повторной попытки.
+        """
+        async with self._lock:
+            if not self._rows:
+                return
+
+            batch, self._rows = self._rows, []
+            self._inflight = batch
+            # до записи: чтение, начатое раньше, повторится и возьмёт строки из БД или из буфера
+            self.generation += 1
+            try:
+                # Строки пишутся подряд идущими группами одной роли в порядке буфера:
+                # id растут в порядке сообщений, и история (ORDER BY time DESC, id DESC)
+                # не путается внутри одной секунды. Запросы одной формы для каждой роли.
+                async with self.main.mysql.transaction() as tx:
+                    for is_user, rows in groupby(batch, key=lambda r: r['role'] == 0):
+                        rows = list(rows)
+                        if is_user:
+                            await tx.executemany(
+                                "INSERT INTO rec_dialog (client_id, role, content, `time`) VALUES (%s, %s, %s, %s)",
+                                [(r['client_id'], r['role'], r['content'], r['time']) for r in rows]
+                            )
+                        elif self.tokens_cached:
+                            await tx.executemany("""
+                                INSERT INTO rec_dialog (
+                                    client_id, role, content,
+                                    tokens_in, tokens_out, tokens_cached,
+                                    price_in, price_out, `time`
+                                )
+                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+                            """, [
+                                (r['client_id'], r['role'], r['content'], r['tokens_in'], r['tokens_out'],
+                                 r['tokens_cached'], r['price_in'], r['price_out'], r['time'])
+                                for r in rows
+                            ])
+                        else:
+                            await tx.executemany("""
+                                INSERT INTO rec_dialog (
+                                    client_id, role, content,
+                                    tokens_in, tokens_out,
+                                    price_in, price_out, `time`
+                                )
+                                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                            """, [
+                                (r['client_id'], r['role'], r['content'], r['tokens_in'], r['tokens_out'],
+                                 r['price_in'], r['price_out'], r['time'])
+                                for r in rows
+                            ])
+                self.generation += 1
+            except BaseException:
+                self._rows = batch + self._rows
+                raise
+            finally:
+                self._inflight = []
+
+    async def shutdown(self):
+        """Останавливает фоновую задачу и записывает остаток буфера."""
+        if self.processing_task:
+            self.processing_task.cancel()
+            try:
+                await self.processing_task
+            except asyncio.CancelledError:
+                pass
+            self.processing_task = None
+        await self.flush()
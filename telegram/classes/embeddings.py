@@ -0,0 +1,120 @@
+# telegram/classes/embeddings.py
+# Кэш эмбеддингов вопросов: память процесса + SQLite на диске
+
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from classes.cache import LRUCache
+
+class EmbeddingCache:
+    """
+    Эмбеддинги по нормализованному тексту вопроса и модели эмбеддингов.
+    Первый уровень - LRU в памяти, второй - SQLite-файл (векторы float32 в BLOB),
+    который сохраняется между перезапусками. Обращения к SQLite выполняются
+    в отдельном потоке, по одному.
+    """
+
+    def __init__(self, main):
+        self.main = main
+        self.memory = LRUCache(self.main.env.get_int('EMBEDDING_CACHE_SIZE', 5000))
+
+        # пустой путь - без дискового уровня
+        path = self.main.env.get('EMBEDDING_CACHE_PATH')
+        self.path = 'base/embeddings.sqlite' if path is None else path
+
+        self._db = None
+        self._executor = None
+        self.disk_hits = 0
+        self.disk_misses = 0
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return re.sub(r'\s+', ' ', text.strip().lower())
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha1(f'{model}\n{text}'.encode('utf-8')).hexdigest()
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS embedding (
+                    `key` TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created REAL NOT NULL
+                )
+            """)
+            self._db.commit()
+        return self._db
+
+    def _load(self, key: str):
+        row = self._connect().execute("SELECT vector FROM embedding WHERE `key` = ?", (key,)).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def _save(self, key: str, model: str, text: str, vector):
+        db = self._connect()
+        db.execute(
+            "INSERT OR REPLACE INTO embedding (`key`, model, text, vector, created) VALUES (?, ?, ?, ?, ?)",
+            (key, model, text, np.asarray(vector, dtype=np.float32).tobytes(), time.time())
+        )
+        db.commit()
+
+    async def _disk(self, func, *args):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embedding-cache')
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def get(self, model: str, text: str):
+        """
+        Вектор из кэша (память, затем диск) или None.
+        """
+        key = self.key(model, text)
+        vector = self.memory.get(key)
+        if vector is not None or not self.path:
+            return vector
+
+        try:
+            vector = await self._disk(self._load, key)
+        except sqlite3.Error as e:
+            await self.main.log.log_info('embeddings', 'Ошибка чтения кэша эмбеддингов', str(e))
+            vector = None
+        if vector is None:
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        self.memory.set(key, vector)
+        return vector
+
+    async def put(self, model: str, text: str, vector):
+        key = self.key(model, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        self.memory.set(key, vector)
+        if not self.path:
+            return
+        try:
+            await self._disk(self._save, key, model, text, vector)
+        except sqlite3.Error as e:
+            await self.main.log.log_info('embeddings', 'Ошибка записи кэша эмбеддингов', str(e))
+
+    def stats(self) -> dict:
+        size = os.path.getsize(self.path) if self.path and os.path.exists(self.path) else 0
+        return {
+            'memory': self.memory.stats(),
+            'disk': {'hits': self.disk_hits, 'misses': self.disk_misses, 'mb': round(size / 1024 / 1024, 2)}
+        }
+
+    async def shutdown(self):
+        if self._executor is not None:
+            if self._db is not None:
+                await self._disk(self._db.close)
+            self._executor.shutdown(wait=False)
+        self._db = self._executor = None
@@ -1,29 +1,335 @@
 # telegram/classes/gpt.py
 # Класс для работы с GPT
 
+import asyncio
+import httpx
+import time
 from openai import AsyncOpenAI
+from openai import RateLimitError, APIConnectionError, APIStatusError
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores import FAISS
 from langchain.docstore.document import Document
 import json
 import re
-import os
-import time
+from types import SimpleNamespace
+from classes.limiter import RateLimiter
+from classes.stream import AnswerExtractor
+from classes.resilience import LLMError, CircuitBreaker, LatencyWindow, backoff_delay
 
 class Gpt():
     def __init__(self, main):
         self.main = main
 
+        # общие HTTP-клиенты и клиенты OpenAI (создаются при первом обращении)
+        self._http = None
+        self._http_sync = None
+        self._client = None
+        self._embeddings = None
+
+        # ограничители запросов по моделям
+        self.limiters = {}
+
+        # предохранитель вызовов OpenAI и задержки успешных вызовов по моделям (для hedging)
+        self.breaker = CircuitBreaker(
+            self.main.env.get_int('OPENAI_BREAKER_FAILURES', 5),
+            self.main.env.get_float('OPENAI_BREAKER_RESET', 30.0)
+        )
+        self.latencies = {}
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
     def getKey(self):
         return self.main.env.get('OPENAI_API_KEY')
 
+    def http_settings(self) -> dict:
+        """
+        Параметры пула HTTP-соединений к OpenAI из .env.
+        """
+        env = self.main.env
+        return {
+            'limits': httpx.Limits(
+                max_connections=env.get_int('OPENAI_MAX_CONNECTIONS', 100),
+                max_keepalive_connections=env.get_int('OPENAI_MAX_KEEPALIVE', 20),
+                keepalive_expiry=env.get_float('OPENAI_KEEPALIVE_EXPIRY', 60.0)
+            ),
+            'timeout': httpx.Timeout(
+                env.get_float('OPENAI_READ_TIMEOUT', 60.0),
+                connect=env.get_float('OPENAI_CONNECT_TIMEOUT', 5.0)
+            ),
+            'http2': bool(env.get_int('OPENAI_HTTP2'))
+        }
+
+    def get_client(self) -> AsyncOpenAI:
+        """
+        Возвращает общий на весь процесс клиент AsyncOpenAI.
+        """
+        if self._client is None:
+            self._http = httpx.AsyncClient(**self.http_settings())
+            # повторы выполняет create() (с учётом дедлайна хода), поэтому в клиенте они отключены
+            self._client = AsyncOpenAI(api_key=self.getKey(), http_client=self._http, max_retries=0)
+        return self._client
+
+    def get_embeddings(self) -> OpenAIEmbeddings:
+        """
+        Возвращает общий объект эмбеддингов, использующий те же настройки пула соединений.
+        """
+        if self._embeddings is None:
+            self.get_client()
+            self._http_sync = httpx.Client(**self.http_settings())
+            self._embeddings = OpenAIEmbeddings(
+                api_key=self.getKey(),
+                http_client=self._http_sync,
+                http_async_client=self._http
+            )
+        return self._embeddings
+
+    async def shutdown(self):
+        """
+        Закрывает HTTP-соединения (вызывается при остановке бота).
+        """
+        if self._client is not None:
+            await self._client.close()
+        if self._http_sync is not None:
+            self._http_sync.close()
+        self._http = self._http_sync = self._client = self._embeddings = None
+
+    def get_limiter(self, model: str) -> RateLimiter:
+        if model not in self.limiters:
+            self.limiters[model] = RateLimiter()
+        return self.limiters[model]
+
+    def estimate_tokens(self, messages) -> int:
+        """
+        Грубая оценка стоимости запроса в токенах: ~4 символа на токен плюс ожидаемый ответ.
+        """
+        chars = sum(len(str(m.get('content', ''))) for m in messages)
+        return chars // 4 + self.main.env.get_int('OPENAI_COMPLETION_ESTIMATE', 500)
+
+    def get_latency(self, model: str) -> LatencyWindow:
+        if model not in self.latencies:
+            self.latencies[model] = LatencyWindow()
+        return self.latencies[model]
+
+    @staticmethod
+    def remaining(deadline: float = None):
+        """
+        Остаток времени до дедлайна (time.monotonic()) в секундах или None без дедлайна.
+        """
+        return None if deadline is None else deadline - time.monotonic()
+
+    async def send(self, model: str, messages, limiter: RateLimiter, tokens: int, progress: dict, **kwargs):
+        """
+        Одна попытка вызова chat.completions.create с учётом лимитов RPM/TPM.
+        После ожидания бюджета отмечает в `progress['sent']`, что запрос ушёл в OpenAI.
+        """
+        await limiter.acquire(tokens)
+        progress['sent'] = True
+        started = time.monotonic()
+        raw = await self.get_client().chat.completions.with_raw_response.create(
+            model=model,
+            messages=messages,
+            **kwargs
+        )
+        limiter.update(raw.headers)
+        response = raw.parse()
+        if not kwargs.get('stream'):
+            self.get_latency(model).add(time.monotonic() - started)
+        return response
+
+    async def hedged(self, model: str, messages, limiter: RateLimiter, tokens: int, progress: dict, **kwargs):
+        """
+        Попытка с дублированием (OPENAI_HEDGE=1): если ответа нет дольше p95 последних
+        вызовов, отправляется второй такой же запрос и берётся первый успешный.
+        """
+        env = self.main.env
+        latency = self.get_latency(model)
+        enabled = env.get_int('OPENAI_HEDGE') and not kwargs.get('stream') \
+            and len(latency) >= env.get_int('OPENAI_HEDGE_MIN_SAMPLES', 20)
+        if not enabled:
+            return await self.send(model, messages, limiter, tokens, progress, **kwargs)
+
+        delay = latency.percentile(env.get_float('OPENAI_HEDGE_PERCENTILE', 95.0))
+        primary = asyncio.create_task(self.send(model, messages, limiter, tokens, progress, **kwargs))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                return primary.result()
+
+            self.hedges += 1
+            backup = asyncio.create_task(self.send(model, messages, limiter, tokens, progress, **kwargs))
+            pending = {primary, backup}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def create(self, model: str, messages, deadline: float = None, **kwargs):
+        """
+        Вызов chat.completions.create с повторами в пределах дедлайна хода (`deadline`,
+        по time.monotonic()). Повторяются 429 (после ожидания бюджета RPM/TPM), 5xx и
+        сетевые ошибки - с экспоненциальной задержкой и разбросом. Подряд идущие ошибки
+        сервиса открывают предохранитель, и вызовы сразу завершаются LLMError('circuit').
+        """
+        env = self.main.env
+        limiter = self.get_limiter(model)
+        tokens = self.estimate_tokens(messages)
+        rate_retries = env.get_int('OPENAI_RATE_RETRIES', 3)
+        retries = env.get_int('OPENAI_RETRIES', 2)
+        base = env.get_float('OPENAI_RETRY_BASE', 0.5)
+        cap = env.get_float('OPENAI_RETRY_MAX', 8.0)
+
+        rate_attempt = attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise LLMError('OpenAI временно недоступен', 'circuit')
+            remaining = self.remaining(deadline)
+            if remaining is not None and remaining <= 0:
+                raise LLMError('Истекло время ожидания ответа', 'deadline')
+
+            progress = {'sent': False}
+            try:
+                async with asyncio.timeout(remaining):
+                    response = await self.hedged(model, messages, limiter, tokens, progress, **kwargs)
+                self.breaker.success()
+                return response
+            except TimeoutError:
+                # дедлайн, истёкший в очереди ограничителя, - не признак неисправности сервиса
+                if progress['sent']:
+                    self.breaker.failure()
+                raise LLMError('Истекло время ожидания ответа', 'deadline')
+            except RateLimitError as e:
+                # лимит запросов - не признак неисправности сервиса
+                limiter.backoff(e.response.headers if e.response is not None else None)
+                rate_attempt += 1
+                await self.main.log.log_info('telegram', 'Превышен лимит OpenAI, повтор', {'model': model, 'attempt': rate_attempt})
+                if rate_attempt > rate_retries:
+                    raise LLMError(str(e)) from e
+                continue
+            except (APIConnectionError, APIStatusError) as e:
+                status = getattr(e, 'status_code', None)
+                if status is not None and status < 500:
+                    # ошибка запроса (4xx) - сервис отвечает, повтор не поможет
+                    self.breaker.success()
+                    raise LLMError(str(e)) from e
+                self.breaker.failure()
+                if attempt >= retries:
+                    raise LLMError(str(e)) from e
+                delay = backoff_delay(attempt, base, cap)
+                attempt += 1
+                self.retries += 1
+                await self.main.log.log_info('telegram', 'Ошибка OpenAI, повтор', {
+                    'model': model, 'attempt': attempt, 'status': status, 'delay': round(delay, 2)
+                })
+                remaining = self.remaining(deadline)
+                if remaining is not None and delay >= remaining:
+                    raise LLMError('Истекло время ожидания ответа', 'deadline') from e
+                await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            'breaker': self.breaker.stats(),
+            'retries': self.retries,
+            'hedges': self.hedges,
+            'hedge_wins': self.hedge_wins,
+            'p95_ms': {model: round(latency.percentile(95) * 1000) for model, latency in self.latencies.items()},
+            'limiters': {model: limiter.stats() for model, limiter in self.limiters.items()}
+        }
+
+    def tool_options(self, tools: list = None) -> dict:
+        """
+        Параметры запроса для режима инструментов (без инструментов - пусто).
+        """
+        return {'tools': tools, 'parallel_tool_calls': True} if tools else {}
+
+    async def request_stream(self, messages, on_answer, model: str = 'gpt-4o-mini', format: dict = None, temperature: int = 0.5, tools: list = None, deadline: float = None):
+        """
+        Потоковый запрос: по мере генерации JSON передаёт в `on_answer(text)` текущее
+        значение поля "answer". Возвращает объект с тем же интерфейсом, что и `request`
+        (`choices[0].message.content`, `.tool_calls`, `usage`).
+        Повторяется только установка соединения; обрыв потока, как и прочие ошибки, - LLMError.
+        """
+        extractor = AnswerExtractor()
+        content = []
+        tool_calls = {}     # index → фрагменты вызова инструмента
+        usage = None
+        finish_reason = None
+        answer = ''
+
+        try:
+            stream = await self.create(
+                model=model,
+                messages=messages,
+                temperature=temperature,
+                response_format=format,
+                stream=True,
+                stream_options={'include_usage': True},
+                deadline=deadline,
+                **self.tool_options(tools)
+            )
+        except LLMError as e:
+            await self.main.log.log_info('telegram', 'Ошибка при запросе', {'reason': e.reason, 'error': str(e)})
+            raise
+
+        try:
+            async with asyncio.timeout(self.remaining(deadline)):
+                async for chunk in stream:
+                    if chunk.usage is not None:
+                        usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    finish_reason = choice.finish_reason or finish_reason
+                    for call in (choice.delta.tool_calls if choice.delta else None) or []:
+                        item = tool_calls.setdefault(call.index, {'id': None, 'name': '', 'arguments': []})
+                        item['id'] = call.id or item['id']
+                        if call.function:
+                            item['name'] += call.function.name or ''
+                            item['arguments'].append(call.function.arguments or '')
+                    delta = choice.delta.content if choice.delta else None
+                    if delta:
+                        content.append(delta)
+                        value = extractor.feed(delta)
+                        if value != answer:
+                            answer = value
+                            await on_answer(answer)
+        except TimeoutError:
+            self.breaker.failure()
+            raise LLMError('Истекло время ожидания ответа', 'deadline')
+        except (APIConnectionError, APIStatusError, httpx.HTTPError) as e:
+            self.breaker.failure()
+            raise LLMError(str(e)) from e
+
+        calls = [
+            SimpleNamespace(id=item['id'], type='function', function=SimpleNamespace(
+                name=item['name'], arguments=''.join(item['arguments'])
+            ))
+            for _, item in sorted(tool_calls.items())
+        ]
+        message = SimpleNamespace(role='assistant', content=''.join(content), tool_calls=calls or None)
+        response = SimpleNamespace(
+            choices=[SimpleNamespace(index=0, message=message, finish_reason=finish_reason)],
+            usage=usage,
+            model=model
+        )
+        await self.main.log.log_info('telegram', 'Получен ответ', response, True)
+        return response
+
     def createDocum(self, chunk, metadata):
         return Document(page_content=chunk, metadata=metadata)
 
     def createIndex(self, chunks):
-        AsyncOpenAI.api_key = os.environ['OPENAI_API_KEY'] = self.getKey()
-        embeddings = OpenAIEmbeddings()
-        return FAISS.from_documents(chunks, embeddings)
+        return FAISS.from_documents(chunks, self.get_embeddings())
 
     async def find_chunks(self, db, question, count):
         if count:
@@ -39,9 +345,11 @@ class Gpt():
             docs = await db.asimilarity_search('', filter=filter)
         return docs
 
-    async def request(self, messages, model: str = 'gpt-4o-mini', format: dict = None, temperature: int = 0.5):
-        client = AsyncOpenAI(api_key=self.getKey())
-
+    async def request(self, messages, model: str = 'gpt-4o-mini', format: dict = None, temperature: int = 0.5, tools: list = None, deadline: float = None):
+        """
+        Запрос ответа модели. При неудаче (после повторов, по дедлайну или
+        открытому предохранителю) выбрасывает LLMError.
+        """
         if False:
             await self.main.log.log_info('telegram', 'Запрос в OpenAI', {
                 'model': model,
@@ -50,41 +358,21 @@ class Gpt():
             }, True)
 
         try:
-            response = await client.chat.completions.create(
+            response = await self.create(
                 model=model,
                 messages=messages,
                 temperature=temperature,
-                response_format=format
+                response_format=format,
+                deadline=deadline,
+                **self.tool_options(tools)
             )
+        except LLMError as e:
+            await self.main.log.log_info('telegram', 'Ошибка при запросе', {'reason': e.reason, 'error': str(e)})
+            raise
 
-            if 'headers' in response:
-                headers = response.headers
-
-                # RPM/RPD контроль
-                remaining_requests = int(headers.get('x-ratelimit-remaining-requests', 0))
-                reset_requests = headers.get('x-ratelimit-reset-requests')
-                if remaining_requests <= 0:
-                    if reset_requests:
-                        wait_time = float(reset_requests.strip('s'))
-                        time.sleep(wait_time)
-                    return 'Превышен лимит запросов в минуту. Попробуйте позже.'
-
-                # TPM контроль
-                remaining_tokens = int(headers.get('x-ratelimit-remaining-tokens', 0))
-                reset_tokens = headers.get('x-ratelimit-reset-tokens')
-                if remaining_tokens <= 0:
-                    if reset_tokens:
-                        wait_time = float(reset_tokens.strip('s'))
-                        time.sleep(wait_time)
-                    return 'Превышен лимит токенов в минуту. Попробуйте позже.'
-
-            if response.choices:
-                await self.main.log.log_info('telegram', 'Получен ответ', response, True)
-                return response
-            else:
-                await self.main.log.log_info('telegram', 'Не удалось получить ответ от модели.')
-                return 'Не удалось получить ответ от модели.'
+        if not response.choices:
+            await self.main.log.log_info('telegram', 'Не удалось получить ответ от модели.')
+            raise LLMError('Не удалось получить ответ от модели.', 'empty')
 
-        except Exception as e:
-            await self.main.log.log_info('telegram', 'Ошибка при запросе', str(e))
-            return f'Ошибка при запросе в OpenAI: {e}'
+        await self.main.log.log_info('telegram', 'Получен ответ', response, True)
+        return response
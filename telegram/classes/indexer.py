@@ -0,0 +1,327 @@
+# telegram/classes/indexer.py
+# Сборка индекса базы знаний FAISS и сравнение типов индексов
+#
+# Запуск из каталога telegram:
+#   python -m classes.indexer build [flat|hnsw|ivf|ivfpq] [источник.md] [каталог индекса]
+#   python -m classes.indexer update [источник.md] [каталог индекса]
+#   python -m classes.indexer bench [источник.md] [файл с вопросами]
+
+import hashlib
+import json
+import math
+import os
+import shutil
+import statistics
+import time
+from datetime import datetime
+import faiss
+import numpy as np
+from langchain.text_splitter import MarkdownHeaderTextSplitter
+from langchain.docstore.document import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+
+INDEX_TYPES = ('flat', 'hnsw', 'ivf', 'ivfpq')
+
+class Indexer:
+    """
+    Разбивает markdown-файл базы знаний на чанки по заголовкам, получает эмбеддинги
+    пачками и собирает индекс FAISS выбранного типа в формате FAISS.save_local
+    (тот же, что читает Chunks). Идентификатор чанка - хэш его текста.
+    Рядом с индексом сохраняются манифест (модель эмбеддингов, тип индекса, id чанков)
+    и векторы чанков в том же порядке, по которым `update` заново получает эмбеддинги
+    только для новых и изменённых чанков.
+    """
+
+    MANIFEST = 'manifest.json'
+    VECTORS = 'vectors.npy'
+
+    HEADERS = [('#', 'h1'), ('##', 'h2'), ('###', 'h3')]
+
+    def __init__(self, main):
+        self.main = main
+        self.batch_size = self.main.env.get_int('INDEX_EMBED_BATCH', 100)
+
+    @staticmethod
+    def chunk_id(text: str) -> str:
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    def split(self, path: str) -> list:
+        """
+        Чанки markdown-файла (документы с метаданными заголовков), без повторов.
+        """
+        with open(path, encoding='utf-8') as f:
+            text = f.read()
+        splitter = MarkdownHeaderTextSplitter(headers_to_split_on=self.HEADERS, strip_headers=False)
+        documents = {}
+        for doc in splitter.split_text(text):
+            content = doc.page_content.strip()
+            if content:
+                documents.setdefault(self.chunk_id(content), Document(page_content=content, metadata=doc.metadata))
+        return list(documents.items())
+
+    async def embed(self, texts: list) -> np.ndarray:
+        """
+        Эмбеддинги текстов запросами по INDEX_EMBED_BATCH штук.
+        """
+        embeddings = self.main.gpt.get_embeddings()
+        vectors = []
+        for i in range(0, len(texts), self.batch_size):
+            vectors += await embeddings.aembed_documents(texts[i:i + self.batch_size])
+        return np.asarray(vectors, dtype=np.float32).reshape(len(texts), -1)
+
+    @staticmethod
+    def make_index(kind: str, vectors: np.ndarray):
+        """
+        Пустой обученный индекс FAISS типа `kind` под векторы `vectors`.
+        Параметры подбираются по размеру корпуса.
+        """
+        n, d = vectors.shape
+        if kind == 'flat':
+            return faiss.IndexFlatL2(d)
+        if kind == 'hnsw':
+            index = faiss.IndexHNSWFlat(d, 32)
+            index.hnsw.efConstruction = 80
+            index.hnsw.efSearch = 64
+            return index
+
+        # IVF: ~4√n списков, но не меньше ~39 векторов обучения на список
+        nlist = max(1, min(int(4 * math.sqrt(n)), n // 39))
+        quantizer = faiss.IndexFlatL2(d)
+        if kind == 'ivf':
+            index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        elif kind == 'ivfpq':
+            # подвекторов - наибольший делитель d не больше 64, кодов - не больше числа векторов
+            m = max(x for x in range(1, 65) if d % x == 0)
+            nbits = max(1, min(8, int(math.log2(max(n, 2)))))
+            index = faiss.IndexIVFPQ(quantizer, d, nlist, m, nbits)
+        else:
+            raise ValueError(f'Неизвестный тип индекса: {kind} (допустимы: {", ".join(INDEX_TYPES)})')
+        index.train(vectors)
+        index.nprobe = max(1, nlist // 8)
+        return index
+
+    def to_store(self, index, documents: list) -> FAISS:
+        """
+        Хранилище langchain поверх индекса FAISS и чанков [(id, Document)].
+        """
+        return FAISS(
+            embedding_function=self.main.gpt.get_embeddings(),
+            index=index,
+            docstore=InMemoryDocstore(dict(documents)),
+            index_to_docstore_id={i: doc_id for i, (doc_id, _) in enumerate(documents)}
+        )
+
+    def manifest(self, kind: str, source: str, store: FAISS) -> dict:
+        return {
+            'model': self.main.gpt.get_embeddings().model,
+            'type': kind,
+            'source': source,
+            'updated': datetime.now().isoformat(timespec='seconds'),
+            'chunks': [store.index_to_docstore_id[i] for i in range(store.index.ntotal)]
+        }
+
+    def load_manifest(self, path: str):
+        try:
+            with open(os.path.join(path, self.MANIFEST), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load_vectors(self, path: str, manifest: dict):
+        """
+        Сохранённые векторы чанков {id: вектор} или None, если их нет или они не совпадают с манифестом.
+        """
+        try:
+            vectors = np.load(os.path.join(path, self.VECTORS))
+        except (OSError, ValueError):
+            return None
+        if len(vectors) != len(manifest.get('chunks', [])):
+            return None
+        return dict(zip(manifest['chunks'], vectors))
+
+    def save(self, store: FAISS, path: str, manifest: dict, vectors: np.ndarray):
+        """
+        Сохраняет индекс с манифестом и векторами во временный каталог и переносит файлы в `path`
+        по одному (os.replace), так что каталог и каждый файл индекса существуют всегда.
+        index.faiss переносится последним: Chunks сверяет время изменения обоих файлов
+        до и после загрузки и повторяет загрузку, если попал между заменами.
+        """
+        tmp = f'{path}.tmp'
+        shutil.rmtree(tmp, ignore_errors=True)
+        store.save_local(tmp)
+        with open(os.path.join(tmp, self.MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        np.save(os.path.join(tmp, self.VECTORS), vectors)
+        os.makedirs(path, exist_ok=True)
+        for name in (self.VECTORS, 'index.pkl', self.MANIFEST, 'index.faiss'):
+            os.replace(os.path.join(tmp, name), os.path.join(path, name))
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    @staticmethod
+    def memory(index) -> int:
+        """
+        Объём индекса в байтах (по сериализованному виду).
+        """
+        return int(faiss.serialize_index(index).nbytes)
+
+    async def build(self, kind: str, source: str, path: str) -> dict:
+        if kind not in INDEX_TYPES:
+            raise ValueError(f'Неизвестный тип индекса: {kind} (допустимы: {", ".join(INDEX_TYPES)})')
+        started = time.perf_counter()
+        documents = self.split(source)
+        if not documents:
+            raise ValueError(f'В {source} нет чанков')
+        vectors = await self.embed([doc.page_content for _, doc in documents])
+        embedded = time.perf_counter()
+
+        index = self.make_index(kind, vectors)
+        index.add(vectors)
+        store = self.to_store(index, documents)
+        self.save(store, path, self.manifest(kind, source, store), vectors)
+        return {
+            'type': kind,
+            'chunks': len(documents),
+            'dim': vectors.shape[1],
+            'embed_s': round(embedded - started, 2),
+            'build_s': round(time.perf_counter() - embedded, 2),
+            'ram_mb': round(self.memory(index) / 1024 / 1024, 2)
+        }
+
+    async def update(self, source: str, path: str) -> dict:
+        """
+        Инкрементальное обновление индекса по манифесту: эмбеддинги запрашиваются только
+        для новых и изменённых чанков, остальные берутся из сохранённых векторов.
+        Индекс любого типа собирается заново из этих векторов (IVF/IVF-PQ обучаются заново):
+        HNSW не поддерживает удаление, а remove_ids в IVF сохраняет номера векторов,
+        которые FAISS.delete из langchain перенумеровывает как после сдвига.
+        Без манифеста или сохранённых векторов и при смене модели эмбеддингов
+        эмбеддинги запрашиваются для всех чанков.
+        """
+        started = time.perf_counter()
+        documents = self.split(source)
+        if not documents:
+            raise ValueError(f'В {source} нет чанков')
+
+        manifest = self.load_manifest(path)
+        kind = (manifest or {}).get('type', 'flat')
+        stored = None
+        if manifest and manifest.get('model') == self.main.gpt.get_embeddings().model:
+            stored = self.load_vectors(path, manifest)
+        if stored is None:
+            return {**await self.build(kind, source, path), 'mode': 'full'}
+
+        new_ids = {doc_id for doc_id, _ in documents}
+        removed = len(set(stored) - new_ids)
+        added = [(doc_id, doc) for doc_id, doc in documents if doc_id not in stored]
+
+        if added:
+            vectors = await self.embed([doc.page_content for _, doc in added])
+            stored.update((doc_id, vector) for (doc_id, _), vector in zip(added, vectors))
+        if removed or added:
+            vectors = np.vstack([stored[doc_id] for doc_id, _ in documents])
+            index = self.make_index(kind, vectors)
+            index.add(vectors)
+            store = self.to_store(index, documents)
+            self.save(store, path, self.manifest(kind, source, store), vectors)
+
+        return {
+            'mode': 'incremental',
+            'type': kind,
+            'chunks': len(documents),
+            'added': len(added),
+            'removed': removed,
+            'kept': len(documents) - len(added),
+            'seconds': round(time.perf_counter() - started, 2)
+        }
+
+    async def benchmark(self, source: str, questions: list = None, k: int = 5) -> list:
+        """
+        Сравнивает типы индексов с точным (flat): recall@k, задержка поиска p50/p99, объём.
+        Вопросы - из файла или (если не заданы) зашумлённые векторы самих чанков.
+        """
+        documents = self.split(source)
+        vectors = await self.embed([doc.page_content for _, doc in documents])
+        if questions:
+            queries = await self.embed(questions)
+        else:
+            rng = np.random.default_rng(0)
+            sample = vectors[rng.choice(len(vectors), min(len(vectors), 200), replace=False)]
+            queries = sample + rng.normal(0, 0.01, sample.shape).astype(np.float32)
+
+        k = min(k, len(vectors))
+        baseline = None
+        report = []
+        for kind in INDEX_TYPES:
+            try:
+                index = self.make_index(kind, vectors)
+            except Exception as e:
+                report.append({'type': kind, 'error': str(e)})
+                continue
+            index.add(vectors)
+
+            timings, found = [], []
+            for query in queries:
+                started = time.perf_counter()
+                _, ids = index.search(query.reshape(1, -1), k)
+                timings.append((time.perf_counter() - started) * 1000)
+                found.append(set(ids[0]) - {-1})
+            if baseline is None:
+                baseline = found
+            timings.sort()
+            report.append({
+                'type': kind,
+                'recall': round(statistics.mean(len(f & b) / k for f, b in zip(found, baseline)), 4),
+                'p50_ms': round(timings[len(timings) // 2], 3),
+                'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))], 3),
+                'ram_mb': round(self.memory(index) / 1024 / 1024, 2)
+            })
+        return report
+
+if __name__ == '__main__':
+    import asyncio
+    import sys
+    from classes.env import Env
+    from classes.log import Log
+    from classes.gpt import Gpt
+
+    class Cli:
+        def __init__(self):
+            self.env = Env()
+            self.log = Log()
+            self.gpt = Gpt(self)
+            self.indexer = Indexer(self)
+
+    async def run(args):
+        app = Cli()
+        command = args[0] if args else 'build'
+        try:
+            if command == 'bench':
+                source = args[1] if len(args) > 1 else 'base/data.md'
+                questions = None
+                if len(args) > 2:
+                    with open(args[2], encoding='utf-8') as f:
+                        questions = [line.strip() for line in f if line.strip()]
+                print(f'{"type":>6} {"recall@5":>9} {"p50, ms":>8} {"p99, ms":>8} {"RAM, MB":>8}')
+                for row in await app.indexer.benchmark(source, questions):
+                    if 'error' in row:
+                        print(f'{row["type"]:>6} ошибка: {row["error"]}')
+                    else:
+                        print(f'{row["type"]:>6} {row["recall"]:>9} {row["p50_ms"]:>8} {row["p99_ms"]:>8} {row["ram_mb"]:>8}')
+            elif command == 'update':
+                source = args[1] if len(args) > 1 else 'base/data.md'
+                path = args[2] if len(args) > 2 else 'base/base08.faiss'
+                print(await app.indexer.update(source, path))
+            elif command == 'build':
+                kind = args[1] if len(args) > 1 else 'flat'
+                source = args[2] if len(args) > 2 else 'base/data.md'
+                path = args[3] if len(args) > 3 else 'base/base08.faiss'
+                print(await app.indexer.build(kind, source, path))
+            else:
+                print('Команды: build [flat|hnsw|ivf|ivfpq] [источник.md] [каталог индекса], update [источник.md] [каталог индекса], bench [источник.md] [файл с вопросами]')
+                return 1
+            return 0
+        finally:
+            await app.gpt.shutdown()
+
+    sys.exit(asyncio.run(run(sys.argv[1:])))
@@ -0,0 +1,109 @@
+# telegram/classes/limiter.py
+# Асинхронный ограничитель запросов к OpenAI по заголовкам x-ratelimit-*
+
+import asyncio
+import re
+import time
+
+def parse_reset(value) -> float:
+    """
+    Переводит длительность из заголовка OpenAI ('1s', '6m0s', '20ms', '1h2m3.5s') в секунды.
+    """
+    if not value:
+        return 0.0
+    units = {'h': 3600.0, 'm': 60.0, 's': 1.0, 'ms': 0.001}
+    total = 0.0
+    for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', str(value)):
+        total += float(number) * units[unit]
+    return total
+
+class RateLimiter:
+    """
+    Бюджет запросов (RPM) и токенов (TPM) одной модели.
+    Остатки и время сброса берутся из заголовков ответа, между ответами
+    бюджет уменьшается по оценке стоимости запроса. Если бюджета не хватает,
+    вызывающий ждёт через asyncio.sleep (цикл событий не блокируется);
+    ожидающие обслуживаются по очереди в порядке прихода.
+    """
+
+    def __init__(self):
+        self.remaining_requests = None      # None - остаток неизвестен
+        self.remaining_tokens = None
+        self.reset_requests_at = 0.0        # time.monotonic() сброса бюджета
+        self.reset_tokens_at = 0.0
+        self._lock = asyncio.Lock()         # очередь ожидающих (FIFO)
+        self.waits = 0
+        self.wait_time = 0.0
+
+    def _expire(self, now: float):
+        # после сброса окна остатки снова неизвестны (до следующего ответа)
+        if self.remaining_requests is not None and now >= self.reset_requests_at:
+            self.remaining_requests = None
+        if self.remaining_tokens is not None and now >= self.reset_tokens_at:
+            self.remaining_tokens = None
+
+    def _delay(self, tokens: int) -> float:
+        now = time.monotonic()
+        self._expire(now)
+        delay = 0.0
+        if self.remaining_requests is not None and self.remaining_requests < 1:
+            delay = max(delay, self.reset_requests_at - now)
+        if self.remaining_tokens is not None and self.remaining_tokens < tokens:
+            delay = max(delay, self.reset_tokens_at - now)
+        return delay
+
+    async def acquire(self, tokens: int):
+        """
+        Ждёт, пока в бюджете будет место для запроса стоимостью `tokens`, и резервирует его.
+        """
+        async with self._lock:
+            started = time.monotonic()
+            waited = False
+            while (delay := self._delay(tokens)) > 0:
+                waited = True
+                await asyncio.sleep(delay)
+            if waited:
+                self.waits += 1
+                self.wait_time += time.monotonic() - started
+
+            if self.remaining_requests is not None:
+                self.remaining_requests -= 1
+            if self.remaining_tokens is not None:
+                self.remaining_tokens -= tokens
+
+    def update(self, headers):
+        """
+        Обновляет бюджет по заголовкам ответа OpenAI.
+        """
+        now = time.monotonic()
+        if headers.get('x-ratelimit-remaining-requests') is not None:
+            self.remaining_requests = int(headers['x-ratelimit-remaining-requests'])
+            self.reset_requests_at = now + parse_reset(headers.get('x-ratelimit-reset-requests'))
+        if headers.get('x-ratelimit-remaining-tokens') is not None:
+            self.remaining_tokens = int(headers['x-ratelimit-remaining-tokens'])
+            self.reset_tokens_at = now + parse_reset(headers.get('x-ratelimit-reset-tokens'))
+
+    def backoff(self, headers=None, default: float = 1.0):
+        """
+        Ответ 429: обнуляет бюджет до сброса (по retry-after / x-ratelimit-reset-*),
+        чтобы следующий acquire() подождал.
+        """
+        headers = headers or {}
+        self.update(headers)
+        delay = parse_reset(headers.get('x-ratelimit-reset-requests')) or parse_reset(headers.get('x-ratelimit-reset-tokens'))
+        if headers.get('retry-after'):
+            try:
+                delay = max(delay, float(headers['retry-after']))
+            except ValueError:
+                pass
+        delay = delay or default
+        self.remaining_requests = 0
+        self.reset_requests_at = max(self.reset_requests_at, time.monotonic() + delay)
+
+    def stats(self) -> dict:
+        return {
+            'remaining_requests': self.remaining_requests,
+            'remaining_tokens': self.remaining_tokens,
+            'waits': self.waits,
+            'wait_time': round(self.wait_time, 3)
+        }
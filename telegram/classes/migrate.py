@@ -0,0 +1,189 @@
+# telegram/classes/migrate.py
+# Версионные миграции схемы MySQL и проверка планов горячих запросов
+#
+# Запуск из каталога telegram:
+#   python -m classes.migrate          - применить новые миграции
+#   python -m classes.migrate check    - EXPLAIN горячих запросов, ошибка при полном сканировании
+
+import asyncio
+import sys
+from datetime import date, datetime, timedelta
+from classes.queries import CLIENT_HISTORY, TODAY_REQUEST_COUNT, WRITE_RECEPT, WRITE_RECEPT_FRIENDS, USER_SUMMARY
+
+# Миграции: (версия, описание, список шагов). Уже применённые версии
+# хранятся в `rec_migration`, поэтому каждая выполняется ровно один раз.
+# Шаг - (вид, таблица, имя индекса / столбца, SQL): DDL в MySQL не откатывается,
+# поэтому шаг пропускается, если индекс или столбец уже есть (повтор после сбоя).
+MIGRATIONS = [
+    (1, 'Индексы для горячих запросов rec_client / rec_dialog / rec_write / rec_friend / rec_event', [
+        # get_or_create_client_id: INSERT ... ON DUPLICATE KEY UPDATE по tel_id
+        ('index', 'rec_client', 'uq_client_tel_id',
+         "ALTER TABLE rec_client ADD UNIQUE KEY uq_client_tel_id (tel_id)"),
+        # get_client_history: client_id + is_delete, сортировка по time
+        ('index', 'rec_dialog', 'idx_dialog_client_time',
+         "ALTER TABLE rec_dialog ADD KEY idx_dialog_client_time (client_id, is_delete, `time`)"),
+        # get_today_request_count: client_id + role + is_delete, диапазон по time
+        ('index', 'rec_dialog', 'idx_dialog_client_role_time',
+         "ALTER TABLE rec_dialog ADD KEY idx_dialog_client_role_time (client_id, role, is_delete, `time`)"),
+        # get_write_recept / get_write_recept_friends / write_me_*: client_id + is_delete → event_id
+        ('index', 'rec_write', 'idx_write_client_event',
+         "ALTER TABLE rec_write ADD KEY idx_write_client_event (client_id, is_delete, event_id)"),
+        # get_write_recept_friends: связи клиента
+        ('index', 'rec_friend', 'idx_friend_client',
+         "ALTER TABLE rec_friend ADD KEY idx_friend_client (client_id, is_delete, friend_id)"),
+        # generate_md_data: актуальные мероприятия по дате
+        ('index', 'rec_event', 'idx_event_date',
+         "ALTER TABLE rec_event ADD KEY idx_event_date (is_delete, `date`, `time`)"),
+    ]),
+    (2, 'rec_dialog.tokens_cached - токены промпта из кэша OpenAI', [
+        ('column', 'rec_dialog', 'tokens_cached',
+         "ALTER TABLE rec_dialog ADD COLUMN tokens_cached INT NOT NULL DEFAULT 0 AFTER tokens_out"),
+    ]),
+]
+
+# Горячие запросы (classes.queries) и примерные параметры для EXPLAIN
+TODAY = datetime.combine(date.today(), datetime.min.time())
+HOT_QUERIES = {
+    'get_client_history': (CLIENT_HISTORY, (1, 22)),
+    'get_today_request_count': (TODAY_REQUEST_COUNT, (1, TODAY, TODAY + timedelta(days=1))),
+    'get_write_recept': (WRITE_RECEPT, (1,)),
+    'get_write_recept_friends': (WRITE_RECEPT_FRIENDS, (1,)),
+    'get_user_summary': (USER_SUMMARY, (1,)),
+}
+
+# Таблицы-справочники, полное сканирование которых допустимо (десятки строк)
+SCAN_ALLOWED = {'rec_place', 'rec_master'}
+
+class Migrate:
+    """
+    Применение версионных миграций и EXPLAIN-проверка горячих запросов.
+    """
+
+    def __init__(self, main):
+        self.main = main
+
+    async def applied_versions(self) -> set:
+        await self.main.mysql.execute("""
+            CREATE TABLE IF NOT EXISTS rec_migration (
+                version INT NOT NULL PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        rows = await self.main.mysql.fetch_all("SELECT version FROM rec_migration")
+        return {r[0] for r in rows}
+
+    async def exists(self, kind: str, table: str, name: str) -> bool:
+        """
+        Есть ли в таблице индекс (kind='index') или столбец (kind='column') с именем `name`.
+        """
+        if kind == 'index':
+            sql = """
+                SELECT COUNT(*) FROM information_schema.STATISTICS
+                WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+            """
+        else:
+            sql = """
+                SELECT COUNT(*) FROM information_schema.COLUMNS
+                WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+            """
+        row = await self.main.mysql.fetch_one(sql, (table, name))
+        return bool(row and row[0])
+
+    async def duplicate_tel_ids(self, limit: int = 20) -> list:
+        """
+        tel_id, встречающиеся в rec_client несколько раз: [(tel_id, "id1,id2,...")].
+        """
+        return await self.main.mysql.fetch_all("""
+            SELECT tel_id, GROUP_CONCAT(id ORDER BY id) FROM rec_client
+            WHERE tel_id IS NOT NULL
+            GROUP BY tel_id HAVING COUNT(*) > 1
+            LIMIT %s
+        """, (limit,))
+
+    async def migrate(self) -> list:
+        """
+        Применяет все ещё не применённые миграции по порядку версий.
+        Возвращает список применённых версий.
+        """
+        applied = await self.applied_versions()
+        done = []
+        for version, description, steps in sorted(MIGRATIONS):
+            if version in applied:
+                continue
+            if version == 1 and not await self.exists('index', 'rec_client', 'uq_client_tel_id'):
+                # уникальный ключ не создастся, пока есть дубликаты клиентов: их нужно объединить вручную
+                # (перенести rec_dialog / rec_write / rec_friend на один id и удалить лишние строки)
+                duplicates = await self.duplicate_tel_ids()
+                if duplicates:
+                    raise RuntimeError('Дубликаты rec_client.tel_id (tel_id: id клиентов): ' + '; '.join(
+                        f'{tel_id}: {ids}' for tel_id, ids in duplicates
+                    ))
+            # DDL в MySQL фиксируется неявно, поэтому версия пишется после всех шагов
+            for kind, table, name, sql in steps:
+                if not await self.exists(kind, table, name):
+                    await self.main.mysql.execute(sql)
+            await self.main.mysql.execute(
+                "INSERT INTO rec_migration (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            done.append(version)
+        return done
+
+    async def explain(self, sql: str, params: tuple = None) -> list:
+        """
+        Возвращает строки EXPLAIN в виде словарей.
+        """
+        async with self.main.mysql.acquire() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.execute('EXPLAIN ' + sql, params or ())
+                names = [d[0] for d in cursor.description]
+                return [dict(zip(names, row)) for row in await cursor.fetchall()]
+
+    async def check(self) -> list:
+        """
+        Выполняет EXPLAIN для всех горячих запросов.
+        Возвращает список проблем: (запрос, таблица) с полным сканированием (type = ALL).
+        """
+        problems = []
+        for name, (sql, params) in HOT_QUERIES.items():
+            for row in await self.explain(sql, params):
+                if row.get('type') == 'ALL' and row.get('table') not in SCAN_ALLOWED:
+                    problems.append((name, row.get('table')))
+        return problems
+
+# запуск из командной строки
+if __name__ == '__main__':
+    from classes.env import Env
+    from classes.log import Log
+    from classes.mysql import MySQL
+
+    class Cli:
+        def __init__(self):
+            self.env = Env()
+            self.log = Log()
+            self.mysql = MySQL(self)
+            self.migrate = Migrate(self)
+
+    async def run(command):
+        app = Cli()
+        try:
+            if command == 'check':
+                problems = await app.migrate.check()
+                for name, table in problems:
+                    print(f'{name}: полное сканирование таблицы {table}')
+                if problems:
+                    return 1
+                print('Все горячие запросы используют индексы')
+            else:
+                try:
+                    done = await app.migrate.migrate()
+                except RuntimeError as e:
+                    print(e)
+                    return 1
+                print(f'Применены миграции: {done}' if done else 'Новых миграций нет')
+            return 0
+        finally:
+            await app.mysql.shutdown()
+
+    sys.exit(asyncio.run(run(sys.argv[1] if len(sys.argv) > 1 else 'migrate')))
@@ -1,14 +1,182 @@
 # telegram/classes/mysql.py
 # Класс для работы с базой данных MySQL
 
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+import re
+import time
 import asyncmy
+from asyncmy.errors import InterfaceError, OperationalError
+from classes.stats import percentile
+
+async def run_cursor(cursor, sql: str, params, fetch: str = None):
+    """
+    Выполняет запрос на курсоре и замеряет время.
+    :return: (результат, число строк, время выполнения, время выборки) - время в секундах
+    """
+    started = time.perf_counter()
+    await cursor.execute(sql, params)
+    executed = time.perf_counter()
+
+    if fetch == 'one':
+        result = await cursor.fetchone()
+        rows = 1 if result else 0
+    elif fetch == 'all':
+        result = await cursor.fetchall()
+        rows = len(result)
+    else:
+        result = None
+        rows = cursor.rowcount
+    fetched = time.perf_counter()
+
+    return result, rows, executed - started, fetched - executed
+
+class QueryStats:
+    """
+    Статистика запросов по нормализованному тексту SQL:
+    число вызовов, число строк, время получения соединения / выполнения / выборки.
+    Для перцентилей хранится ограниченное окно последних замеров.
+    """
+
+    PHASES = ('connect', 'execute', 'fetch')
+
+    def __init__(self, samples: int = 1000):
+        self.samples = samples
+        self.queries = {}
+
+    @staticmethod
+    def normalize(sql: str) -> str:
+        """
+        Схлопывает пробелы и заменяет литералы на `?`, чтобы одинаковые запросы группировались.
+        """
+        sql = re.sub(r"'(?:[^'\\]|\\.)*'", '?', sql)
+        sql = re.sub(r'\b\d+\b', '?', sql)
+        return re.sub(r'\s+', ' ', sql).strip()
+
+    def record(self, sql: str, rows: int, connect: float, execute: float, fetch: float):
+        key = self.normalize(sql)
+        item = self.queries.get(key)
+        if item is None:
+            item = self.queries[key] = {
+                'count': 0,
+                'rows': 0,
+                'total': 0.0,
+                'samples': {phase: deque(maxlen=self.samples) for phase in self.PHASES}
+            }
+        item['count'] += 1
+        item['rows'] += max(rows or 0, 0)
+        item['total'] += connect + execute + fetch
+        for phase, value in zip(self.PHASES, (connect, execute, fetch)):
+            item['samples'][phase].append(value)
+
+    def snapshot(self) -> list:
+        """
+        Возвращает статистику по запросам (время в мс), отсортированную по суммарному времени.
+        """
+        result = []
+        for sql, item in self.queries.items():
+            row = {
+                'sql': sql,
+                'count': item['count'],
+                'rows': item['rows'],
+                'total_ms': round(item['total'] * 1000, 1)
+            }
+            for phase in self.PHASES:
+                values = item['samples'][phase]
+                for p in (50, 95, 99):
+                    row[f'{phase}_p{p}_ms'] = round(percentile(values, p) * 1000, 2)
+            result.append(row)
+        return sorted(result, key=lambda r: r['total_ms'], reverse=True)
+
+    def report(self, limit: int = 10) -> str:
+        """
+        Текстовый отчёт по самым затратным запросам.
+        """
+        lines = []
+        for row in self.snapshot()[:limit]:
+            lines.append(
+                f"{row['sql'][:120]}\n"
+                f"  вызовов: {row['count']}, строк: {row['rows']}, всего: {row['total_ms']} мс\n"
+                f"  connect p50/p95/p99: {row['connect_p50_ms']}/{row['connect_p95_ms']}/{row['connect_p99_ms']} мс\n"
+                f"  execute p50/p95/p99: {row['execute_p50_ms']}/{row['execute_p95_ms']}/{row['execute_p99_ms']} мс\n"
+                f"  fetch p50/p95/p99: {row['fetch_p50_ms']}/{row['fetch_p95_ms']}/{row['fetch_p99_ms']} мс"
+            )
+        return '\n\n'.join(lines) if lines else 'Запросов пока не было'
+
+    def reset(self):
+        self.queries.clear()
+
+class Transaction:
+    """
+    Единица работы: все запросы выполняются на одном соединении
+    и фиксируются одним COMMIT при выходе из блока `mysql.transaction()`.
+    """
+
+    def __init__(self, conn, mysql):
+        self.conn = conn
+        self.mysql = mysql
+        self.lastrowid = None
+
+    async def execute(self, sql: str, params: tuple = None, fetch: str = None):
+        """
+        :param sql: SQL-запрос
+        :param params: параметры запроса
+        :param fetch: None | 'one' | 'all'
+        :return: результат выборки или None
+        """
+        async with self.conn.cursor() as cursor:
+            result, rows, execute_time, fetch_time = await run_cursor(cursor, sql, params or (), fetch)
+            self.lastrowid = cursor.lastrowid
+        await self.mysql.record(sql, params, rows, 0.0, execute_time, fetch_time)
+        return result
+
+    async def execute_return_id(self, sql: str, params: tuple = None) -> int:
+        """
+        Выполняет INSERT и возвращает id вставленной строки.
+        """
+        await self.execute(sql, params)
+        return self.lastrowid
+
+    async def executemany(self, sql: str, seq_params) -> int:
+        """
+        Выполняет запрос для каждого набора параметров, возвращает число затронутых строк.
+        """
+        started = time.perf_counter()
+        async with self.conn.cursor() as cursor:
+            rows = await cursor.executemany(sql, seq_params)
+            self.lastrowid = cursor.lastrowid
+        await self.mysql.record(sql, None, rows, 0.0, time.perf_counter() - started, 0.0)
+        return rows
+
+    async def fetch_all(self, query, params=None):
+        return await self.execute(query, params, fetch='all')
+
+    async def fetch_one(self, query, params=None):
+        return await self.execute(query, params, fetch='one')
 
 class MySQL:
-    
+
     def __init__(self, main):
-        
+
         self.main = main
 
+        # пул соединений (создаётся лениво при первом запросе)
+        self._pool = None
+        self._pool_lock = asyncio.Lock()
+
+        # параметры пула из .env
+        self.pool_min = self.main.env.get_int('MYSQL_POOL_MIN', 1)
+        self.pool_max = self.main.env.get_int('MYSQL_POOL_MAX', 10)
+        self.pool_recycle = self.main.env.get_int('MYSQL_POOL_RECYCLE', 3600)
+        self.acquire_timeout = self.main.env.get_float('MYSQL_POOL_TIMEOUT', 10.0)
+        # соединение, простоявшее дольше (сек), перед выдачей проверяется ping'ом
+        self.ping_idle = self.main.env.get_float('MYSQL_PING_IDLE', 30.0)
+
+        # статистика запросов и порог медленного запроса (мс, 0 - не журналировать)
+        self.stats = QueryStats(self.main.env.get_int('MYSQL_STATS_SAMPLES', 1000))
+        self.slow_ms = self.main.env.get_float('MYSQL_SLOW_MS', 200.0)
+
     async def connect(self):
         return await asyncmy.connect(
             host=self.main.env.get('MYSQL_HOST'),
@@ -17,6 +185,78 @@ class MySQL:
             database=self.main.env.get('MYSQL_DB')
         )
 
+    async def get_pool(self):
+        """
+        Возвращает пул соединений, создавая его при первом обращении.
+        """
+        if self._pool is None:
+            async with self._pool_lock:
+                if self._pool is None:
+                    self._pool = await asyncmy.create_pool(
+                        host=self.main.env.get('MYSQL_HOST'),
+                        user=self.main.env.get('MYSQL_USER'),
+                        password=self.main.env.get('MYSQL_PASSWORD'),
+                        database=self.main.env.get('MYSQL_DB'),
+                        minsize=self.pool_min,
+                        maxsize=self.pool_max,
+                        pool_recycle=self.pool_recycle,
+                        autocommit=True
+                    )
+        return self._pool
+
+    @asynccontextmanager
+    async def acquire(self):
+        """
+        Выдаёт соединение из пула на время блока `async with`.
+        Ожидание свободного соединения ограничено MYSQL_POOL_TIMEOUT.
+        Ping (с переподключением) - только для соединений, простаивавших дольше MYSQL_PING_IDLE.
+        Если блок прерван отменой (таймаут этапа) или ошибкой соединения, состояние протокола
+        неизвестно: соединение закрывается, а не возвращается в пул.
+        """
+        pool = await self.get_pool()
+        conn = await asyncio.wait_for(pool.acquire(), timeout=self.acquire_timeout)
+        try:
+            if asyncio.get_running_loop().time() - conn.last_usage >= self.ping_idle:
+                await conn.ping(reconnect=True)
+            yield conn
+        except (asyncio.CancelledError, InterfaceError, OperationalError):
+            conn.close()
+            raise
+        finally:
+            await pool.release(conn)
+
+    async def record(self, sql: str, params, rows: int, connect: float, execute: float, fetch: float):
+        """
+        Учитывает запрос в статистике и журналирует его, если он медленнее MYSQL_SLOW_MS.
+        """
+        self.stats.record(sql, rows, connect, execute, fetch)
+
+        total_ms = (connect + execute + fetch) * 1000
+        if self.slow_ms and total_ms >= self.slow_ms:
+            await self.main.log.log_info('mysql', 'Медленный запрос', {
+                'sql': QueryStats.normalize(sql),
+                'params': params,
+                'rows': rows,
+                'connect_ms': round(connect * 1000, 2),
+                'execute_ms': round(execute * 1000, 2),
+                'fetch_ms': round(fetch * 1000, 2)
+            })
+
+    async def query(self, sql: str, params, fetch: str = None, commit: bool = False):
+        """
+        Выполняет запрос на соединении из пула с учётом в статистике.
+        """
+        started = time.perf_counter()
+        async with self.acquire() as conn:
+            connect_time = time.perf_counter() - started
+            async with conn.cursor() as cursor:
+                result, rows, execute_time, fetch_time = await run_cursor(cursor, sql, params, fetch)
+                lastrowid = cursor.lastrowid
+            if commit:
+                await conn.commit()
+        await self.record(sql, params, rows, connect_time, execute_time, fetch_time)
+        return result, lastrowid
+
     async def execute(self, sql: str, params: tuple = None, fetch: str = None):
         """
         :param sql: SQL-запрос
@@ -24,31 +264,77 @@ class MySQL:
         :param fetch: None | 'one' | 'all'
         :return: результат выборки или None
         """
-        conn = await self.connect()
-        async with conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(sql, params or ())
-
-                if fetch == 'one':
-                    return await cursor.fetchone()
-                elif fetch == 'all':
-                    return await cursor.fetchall()
-
-            await conn.commit()
-        return None
+        result, _ = await self.query(sql, params or (), fetch, commit=fetch is None)
+        return result
 
     async def fetch_all(self, query, params=None):
-        conn = await self.connect()
-        async with conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(query, params)
-                result = await cursor.fetchall()
-                return result
+        result, _ = await self.query(query, params, 'all')
+        return result
 
     async def fetch_one(self, query, params=None):
-        conn = await self.connect()
-        async with conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute(query, params)
-                result = await cursor.fetchone()
-                return result
\ No newline at end of file
+        result, _ = await self.query(query, params, 'one')
+        return result
+
+    async def execute_return_id(self, sql: str, params: tuple = None) -> int:
+        """
+        Выполняет одиночный INSERT и возвращает id вставленной строки.
+        """
+        _, lastrowid = await self.query(sql, params or ())
+        return lastrowid
+
+    async def has_unique_key(self, table: str, column: str) -> bool:
+        """
+        Есть ли в таблице уникальный ключ ровно по одному столбцу `column`.
+        """
+        row = await self.fetch_one("""
+            SELECT COUNT(*) FROM (
+                SELECT index_name FROM information_schema.STATISTICS
+                WHERE table_schema = DATABASE() AND table_name = %s AND non_unique = 0
+                GROUP BY index_name
+                HAVING COUNT(*) = 1 AND MAX(column_name) = %s
+            ) AS uq
+        """, (table, column))
+        return bool(row and row[0])
+
+    async def has_column(self, table: str, column: str) -> bool:
+        """
+        Есть ли в таблице столбец `column`.
+        """
+        row = await self.fetch_one("""
+            SELECT COUNT(*) FROM information_schema.COLUMNS
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (table, column))
+        return bool(row and row[0])
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Транзакция на одном соединении из пула:
+
+            async with mysql.transaction() as tx:
+                await tx.execute(...)
+                new_id = await tx.execute_return_id(...)
+
+        При исключении внутри блока выполняется ROLLBACK, иначе COMMIT.
+        """
+        async with self.acquire() as conn:
+            await conn.begin()
+            try:
+                yield Transaction(conn, self)
+            except asyncio.CancelledError:
+                # соединение будет закрыто в acquire(), сервер откатит транзакцию сам
+                raise
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+    async def shutdown(self):
+        """
+        Закрывает пул соединений (вызывается при остановке бота).
+        """
+        if self._pool is not None:
+            self._pool.close()
+            await self._pool.wait_closed()
+            self._pool = None
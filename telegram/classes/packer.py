@@ -0,0 +1,96 @@
+# telegram/classes/packer.py
+# Упаковка контекста промпта в бюджет токенов
+
+import tiktoken
+
+class ContextPacker:
+    """
+    Подсчёт токенов локальным токенизатором и заполнение бюджета по приоритету:
+    обязательная часть (system, справочники, данные хода, сообщение пользователя),
+    записи на приём, последние сообщения диалога, чанки базы знаний.
+    Менее приоритетные части обрезаются или отбрасываются.
+    """
+
+    # служебные токены на одно сообщение и на ответ (формат chat completions)
+    MESSAGE_OVERHEAD = 4
+    REPLY_OVERHEAD = 3
+
+    # чанк короче этого остатка бюджета не обрезается, а отбрасывается
+    MIN_CHUNK_TOKENS = 50
+
+    def __init__(self, model: str = None):
+        try:
+            self.encoding = tiktoken.encoding_for_model(model or '')
+        except KeyError:
+            self.encoding = tiktoken.get_encoding('o200k_base')
+
+    def count(self, text: str) -> int:
+        return len(self.encoding.encode(str(text or ''), disallowed_special=()))
+
+    def count_messages(self, messages) -> int:
+        return sum(self.count(m.get('content')) + self.MESSAGE_OVERHEAD for m in messages)
+
+    def truncate(self, text: str, tokens: int) -> str:
+        """
+        Обрезает текст до `tokens` токенов.
+        """
+        encoded = self.encoding.encode(str(text or ''), disallowed_special=())
+        if len(encoded) <= tokens:
+            return text
+        return self.encoding.decode(encoded[:max(tokens, 0)])
+
+    def pack(self, budget: int, fixed: list, bookings: list, history: list, chunks: list):
+        """
+        Заполняет бюджет `budget` токенов.
+
+        :param fixed: обязательные сообщения (не сокращаются)
+        :param bookings: сообщения о записях на приём
+        :param history: сообщения диалога в хронологическом порядке
+        :param chunks: тексты чанков по убыванию релевантности
+        :return: (bookings, history, chunks, отчёт о сокращениях)
+        """
+        used = self.count_messages(fixed) + self.REPLY_OVERHEAD
+        report = {'budget': budget, 'fixed': used, 'cut': {}}
+
+        # 1. Записи на приём: при нехватке места обрезается содержимое
+        packed_bookings = []
+        for message in bookings:
+            tokens = self.count(message['content']) + self.MESSAGE_OVERHEAD
+            if used + tokens > budget:
+                left = budget - used - self.MESSAGE_OVERHEAD
+                message = {**message, 'content': self.truncate(message['content'], left)}
+                tokens = self.count(message['content']) + self.MESSAGE_OVERHEAD
+                report['cut']['bookings_truncated'] = True
+            packed_bookings.append(message)
+            used += tokens
+
+        # 2. История: от новых сообщений к старым, парами «пользователь - ассистент»
+        packed_history = []
+        for end in range(len(history), 0, -2):
+            pair = history[max(end - 2, 0):end]
+            tokens = self.count_messages(pair)
+            if used + tokens > budget:
+                break
+            packed_history = pair + packed_history
+            used += tokens
+        if len(packed_history) < len(history):
+            report['cut']['history_dropped'] = len(history) - len(packed_history)
+
+        # 3. Чанки: по релевантности, последний поместившийся может быть обрезан
+        packed_chunks = []
+        for i, chunk in enumerate(chunks):
+            tokens = self.count(chunk) + 1
+            left = budget - used
+            if tokens > left:
+                if left >= self.MIN_CHUNK_TOKENS:
+                    packed_chunks.append(self.truncate(chunk, left - 1))
+                    report['cut']['chunk_truncated'] = i
+                    used = budget
+                break
+            packed_chunks.append(chunk)
+            used += tokens
+        if len(packed_chunks) < len(chunks):
+            report['cut']['chunks_dropped'] = len(chunks) - len(packed_chunks)
+
+        report['used'] = used
+        return packed_bookings, packed_history, packed_chunks, report
@@ -0,0 +1,55 @@
+# telegram/classes/queries.py
+# Горячие запросы к MySQL: выполняются в Request, планы проверяются в classes.migrate (EXPLAIN)
+
+# История диалога клиента: последние N сообщений (client_id, N)
+CLIENT_HISTORY = """
+    SELECT role, content FROM rec_dialog
+    WHERE client_id = %s AND `is_delete`=0
+    ORDER BY `time` DESC, id DESC
+    LIMIT %s
+"""
+
+# Сообщения клиента за сутки (client_id, начало суток, начало следующих суток).
+# Полуоткрытый интервал вместо DATE(`time`), чтобы работал индекс
+TODAY_REQUEST_COUNT = """
+    SELECT COUNT(*) FROM rec_dialog
+    WHERE client_id = %s AND role = 0 AND `is_delete`=0
+      AND `time` >= %s AND `time` < %s
+"""
+
+# Актуальные записи клиента на приём (client_id)
+WRITE_RECEPT = """
+    SELECT re.place_id, rp.text, re.id, re.date, re.time, rw.client_fio, rw.problem, rm.fio, rm.desc
+    FROM rec_write rw
+    JOIN rec_client rc ON rw.client_id = rc.id
+    JOIN rec_event re ON rw.event_id = re.id
+    JOIN rec_place rp ON re.place_id = rp.id
+    JOIN rec_master rm ON re.master_id = rm.id
+    WHERE rw.is_delete = 0 AND re.date >= CURDATE() AND rw.client_id = %s
+"""
+
+# Актуальные записи друзей клиента на приём (client_id)
+WRITE_RECEPT_FRIENDS = """
+    SELECT
+        re.place_id,
+        rp.text AS place_name,
+        re.id AS event_id,
+        re.date AS event_date,
+        re.time AS event_time,
+        rw.client_fio,
+        rw.problem,
+        rm.fio AS master_fio,
+        rm.`desc` AS master_desc,
+        rw.id,
+        rf.friend_name
+    FROM rec_friend rf
+    JOIN rec_client rc ON rf.client_id = rc.id
+    JOIN rec_write rw ON rw.client_id = rf.friend_id AND rw.is_delete = 0
+    JOIN rec_event re ON rw.event_id = re.id AND re.date >= CURDATE()
+    JOIN rec_place rp ON re.place_id = rp.id
+    JOIN rec_master rm ON re.master_id = rm.id
+    WHERE rf.client_id = %s AND rf.is_delete = 0
+"""
+
+# summary клиента (client_id)
+USER_SUMMARY = "SELECT summary FROM rec_client WHERE id = %s"
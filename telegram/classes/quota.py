@@ -0,0 +1,73 @@
+# telegram/classes/quota.py
+# Дневной лимит запросов пользователя
+
+from datetime import date
+
+class Quota:
+    """
+    Счётчики сообщений клиентов за текущие сутки.
+    Счётчик клиента один раз загружается из БД при первом обращении,
+    дальше увеличивается при сохранении сообщения пользователя.
+    В полночь (по локальному времени) все счётчики сбрасываются.
+    """
+
+    def __init__(self, main):
+        self.main = main
+
+        # лимит и список безлимитных пользователей разбираются один раз
+        self.limit = self.main.env.get_int('DAILY_LIMIT', 20)
+        self.unlimited = {
+            tel_id.strip() for tel_id in (self.main.env.get('UNLIMITED_USERS') or '').split(',')
+            if tel_id.strip()
+        }
+
+        self.day = date.today()
+        self.counts = {}    # client_id → число сообщений за self.day
+
+    def rollover(self):
+        """
+        Сбрасывает счётчики при смене суток.
+        """
+        today = date.today()
+        if today != self.day:
+            self.day = today
+            self.counts.clear()
+
+    def is_unlimited(self, telegram_user_id: str) -> bool:
+        return str(telegram_user_id) in self.unlimited
+
+    async def count(self, client_id: int) -> int:
+        """
+        Возвращает число сообщений клиента за сегодня.
+        """
+        self.rollover()
+        if client_id not in self.counts:
+            count = await self.main.request.load_today_request_count(client_id)
+            # за время запроса счётчик мог быть заведён increment()
+            self.counts.setdefault(client_id, count)
+        return self.counts[client_id]
+
+    async def exceeded(self, client_id: int) -> bool:
+        return await self.count(client_id) >= self.limit
+
+    def increment(self, client_id: int):
+        """
+        Учитывает новое сообщение пользователя (если счётчик клиента уже загружен).
+        """
+        self.rollover()
+        if client_id in self.counts:
+            self.counts[client_id] += 1
+
+    def reset(self, client_id: int):
+        """
+        Обнуляет счётчик после очистки диалога (удалённые сообщения не учитываются).
+        """
+        self.rollover()
+        self.counts[client_id] = 0
+
+    def stats(self) -> dict:
+        return {
+            'day': self.day.isoformat(),
+            'clients': len(self.counts),
+            'limit': self.limit
+        }
@@ -0,0 +1,156 @@
+# telegram/classes/reference.py
+# Кэш справочных данных: адреса, специалисты, расписание
+
+import asyncio
+import json
+import time
+from datetime import date
+from asyncmy.errors import OperationalError
+
+class Reference:
+    """
+    Справочники `rec_place`, `rec_master` и актуальные `rec_event` в памяти процесса.
+    Загружаются один раз, затем обновляются фоновой задачей: раз в REFERENCE_REFRESH_INTERVAL
+    секунд, при смене суток или при изменении отметки обновления таблиц
+    (проверяется каждые REFERENCE_CHECK_INTERVAL секунд).
+    Готовый компактный фрагмент для промпта собирается один раз на каждую загрузку.
+    """
+
+    TABLES = ('rec_place', 'rec_master', 'rec_event')
+
+    # ER_UNKNOWN_SYSTEM_VARIABLE: сервер без information_schema_stats_expiry (MySQL 5.7, MariaDB)
+    UNKNOWN_VARIABLE = 1193
+
+    def __init__(self, main):
+        self.main = main
+        self.refresh_interval = self.main.env.get_float('REFERENCE_REFRESH_INTERVAL', 600.0)
+        self.check_interval = self.main.env.get_float('REFERENCE_CHECK_INTERVAL', 30.0)
+
+        self.places = {}
+        self.masters = {}
+        self.events = {}
+        self.fragment = ''
+
+        self.day = None         # дата, на которую отобраны мероприятия
+        self.stamp = None       # отметка изменения таблиц на момент загрузки
+        self.loaded_at = 0.0
+
+        # поддерживает ли сервер information_schema_stats_expiry (выясняется при первой проверке)
+        self.stats_expiry = True
+
+        self._lock = asyncio.Lock()
+        self.processing_task = None  # фоновая задача обновления
+
+    async def get_stamp(self):
+        """
+        Отметка изменения справочных таблиц (время последнего обновления по information_schema).
+        MySQL 8 отдаёт UPDATE_TIME из кэша статистики (information_schema_stats_expiry,
+        по умолчанию сутки), поэтому на соединении проверки кэш отключается. В MySQL 5.7
+        и MariaDB этой переменной нет, а UPDATE_TIME читается без кэша.
+        """
+        sql = """
+            SELECT TABLE_NAME, UPDATE_TIME FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN (%s, %s, %s)
+        """
+        async with self.main.mysql.acquire() as conn:
+            async with conn.cursor() as cursor:
+                if self.stats_expiry:
+                    try:
+                        await cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+                    except OperationalError as e:
+                        if e.args[0] != self.UNKNOWN_VARIABLE:
+                            raise
+                        self.stats_expiry = False
+                await cursor.execute(sql, self.TABLES)
+                rows = await cursor.fetchall()
+        return tuple(sorted((r[0], str(r[1])) for r in rows))
+
+    async def load(self):
+        """
+        Загружает справочники из БД и собирает фрагмент для промпта.
+        """
+        stamp = await self.get_stamp()
+
+        # places
+        sql_places = "SELECT id, text FROM rec_place WHERE is_delete = 0"
+        rows = await self.main.mysql.fetch_all(sql_places)
+        places = {str(r[0]): r[1] for r in rows}
+
+        # masters
+        sql_masters = "SELECT id, fio, `desc` FROM rec_master WHERE is_delete = 0"
+        rows = await self.main.mysql.fetch_all(sql_masters)
+        masters = {str(r[0]): {"fio": r[1], "desc": r[2] or ""} for r in rows}
+
+        # events - только актуальные, по дате и времени
+        sql_events = """
+            SELECT id, date, TIME_FORMAT(time, '%H:%i') as time_str, place_id, master_id
+            FROM rec_event
+            WHERE is_delete = 0 AND date >= CURDATE()
+            ORDER BY date ASC, time ASC
+        """
+        rows = await self.main.mysql.fetch_all(sql_events)
+        events = {
+            str(r[0]): {
+                "date": r[1].strftime('%Y-%m-%d'),
+                "time": r[2],
+                "place_id": str(r[3]),
+                "master_id": str(r[4])
+            }
+            for r in rows
+        }
+
+        # Компактный фрагмент для промпта
+        compact = {'separators': (',', ':'), 'ensure_ascii': False}
+        fragment = (
+            "📚 Актуальные данные для записи на прием:\n"
+            f"places: {json.dumps(places, **compact)}\n"
+            f"masters: {json.dumps(masters, **compact)}\n"
+            f"events: {json.dumps(events, **compact)}"
+        )
+
+        self.places, self.masters, self.events, self.fragment = places, masters, events, fragment
+        self.day = date.today()
+        self.stamp = stamp
+        self.loaded_at = time.monotonic()
+
+    async def ensure_loaded(self):
+        """
+        Загружает справочники при первом обращении и запускает фоновое обновление.
+        """
+        if self.day is None:
+            async with self._lock:
+                if self.day is None:
+                    await self.load()
+
+        # Если задача еще не запущена, запускаем её
+        if not self.processing_task:
+            self.processing_task = asyncio.create_task(self._process())
+
+    async def get_fragment(self) -> str:
+        """
+        Возвращает готовый фрагмент промпта с адресами, специалистами и расписанием.
+        """
+        await self.ensure_loaded()
+        return self.fragment
+
+    async def _process(self):
+        """Фоновая корутина обновления справочников"""
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                expired = time.monotonic() - self.loaded_at >= self.refresh_interval
+                if expired or self.day != date.today() or await self.get_stamp() != self.stamp:
+                    async with self._lock:
+                        await self.load()
+            except Exception as e:
+                await self.main.log.log_info('reference', 'Ошибка обновления справочников', str(e), True)
+
+    async def shutdown(self):
+        """Останавливает фоновое обновление."""
+        if self.processing_task:
+            self.processing_task.cancel()
+            try:
+                await self.processing_task
+            except asyncio.CancelledError:
+                pass
+            self.processing_task = None
@@ -1,7 +1,9 @@
 # telegram/classes/request
 # Запрос к GPT
 
+import asyncio
 import json
+import time
 from datetime import datetime
 from datetime import date, timedelta
 from telegram import Update
@@ -9,68 +11,240 @@ from telegram.ext import ContextTypes
 from pathlib import Path
 import ast
 from telegram.error import TelegramError
+from classes.cache import LRUCache
+from classes.context import ClientContext
+from classes.dialog import DialogWriter
+from classes.quota import Quota
+from classes.packer import ContextPacker
+from classes.stream import StreamMessage
+from classes.answers import AnswerCache
+from classes.router import ModelRouter
+from classes.tools import TOOLS, REPLIES, CLEAR_DIALOG, call_key
+from classes.queries import CLIENT_HISTORY, TODAY_REQUEST_COUNT, WRITE_RECEPT, WRITE_RECEPT_FRIENDS, USER_SUMMARY
+from classes.resilience import LLMError
 
 class Request:
+
+    # Ответы пользователю при неудачном вызове модели (по LLMError.reason)
+    LLM_ERROR_REPLIES = {
+        'circuit': "Сервис временно перегружен. Пожалуйста, повторите запрос через минуту.",
+        'deadline': "Ответ занимает слишком много времени. Пожалуйста, повторите запрос.",
+        'error': "Извините, не удалось обработать ваш запрос. Пожалуйста, повторите позже."
+    }
+
     def __init__(self, main):
         self.main = main
         self._system_prompt = None
+        self._md_data = None
+        self._demo_data = None
+        self._packer = None
         self.system_path = Path('base/system.md')
 
+        # кэш tel_id → client_id
+        self.client_ids = LRUCache(self.main.env.get_int('CLIENT_CACHE_SIZE', 10000))
+
+        # возможности схемы, добавляемые миграциями (classes.migrate); None - ещё не проверено
+        self.tel_id_unique = None
+        self.tokens_cached_column = None
+
+        # отложенная запись диалога (включается DIALOG_WRITE_BEHIND=1)
+        self.dialog = DialogWriter(main) if self.main.env.get_int('DIALOG_WRITE_BEHIND') else None
+
+        # кэш контекстов диалога client_id → ClientContext
+        self.contexts = LRUCache(
+            self.main.env.get_int('CONTEXT_CACHE_SIZE', 5000),
+            ttl=self.main.env.get_float('CONTEXT_CACHE_TTL', 600.0),
+            maxbytes=self.main.env.get_int('CONTEXT_CACHE_MB', 64) * 1024 * 1024,
+            sizeof=ClientContext.size
+        )
+
+        # дневной лимит запросов
+        self.quota = Quota(main)
+
+        # семантический кэш ответов (включается ANSWER_CACHE=1)
+        self.answers = AnswerCache(main)
+
+        # выбор модели для хода (включается заданием GPT_MODEL_FAST)
+        self.router = ModelRouter(main)
+
+        # вызов функций через инструменты OpenAI вместо строки function_call (GPT_TOOLS=1)
+        self.tools = TOOLS if self.main.env.get_int('GPT_TOOLS') else None
+
+    async def shutdown(self):
+        if self.dialog:
+            await self.dialog.shutdown()
+
+    async def check_schema(self):
+        """
+        Проверяет (один раз) то, что добавляют миграции: бот работает и до их применения.
+        """
+        if self.tel_id_unique is None:
+            self.tel_id_unique = await self.main.mysql.has_unique_key('rec_client', 'tel_id')
+        if self.tokens_cached_column is None:
+            self.tokens_cached_column = await self.main.mysql.has_column('rec_dialog', 'tokens_cached')
+            if self.dialog:
+                self.dialog.tokens_cached = self.tokens_cached_column
+
+    def cache_stats(self) -> dict:
+        """
+        Счётчики кэшей запросов (для /stats).
+        """
+        return {
+            'client_ids': self.client_ids.stats(),
+            'contexts': self.contexts.stats(),
+            'quota': self.quota.stats(),
+            'answers': self.answers.stats(),
+            'router': self.router.stats(),
+            'embeddings': self.main.chunks.embeddings.stats(),
+            'retrieval_batches': {
+                'embed': self.main.chunks.embed_batcher.stats(),
+                'search': self.main.chunks.search_batcher.stats()
+            } if self.main.chunks.embed_batcher else None
+        }
+
+    def get_context(self, client_id: int) -> ClientContext:
+        """
+        Возвращает контекст клиента из кэша, при отсутствии (или смене суток) - новый пустой.
+        """
+        ctx = self.contexts.get(client_id)
+        if ctx is None or ctx.day != date.today():
+            ctx = ClientContext(client_id)
+            self.contexts.set(client_id, ctx)
+        return ctx
+
+    def invalidate_bookings(self, *client_ids):
+        """
+        Сбрасывает закэшированные записи на приём после их изменения.
+        """
+        for client_id in client_ids:
+            ctx = self.contexts.peek(client_id)
+            if ctx is not None:
+                ctx.clear_bookings()
+                self.contexts.update(client_id)
+
+    async def invalidate_bookings_of(self, owner_id: int, *client_ids):
+        """
+        Сбрасывает закэшированные записи после изменения записей клиента `owner_id`:
+        у него самого, у клиентов, записавших его как друга (rec_friend), и у `client_ids`.
+        Владелец неизвестен (None) - сбрасывается только у `client_ids`.
+        """
+        if owner_id is None:
+            self.invalidate_bookings(*client_ids)
+            return
+        try:
+            rows = await self.main.mysql.fetch_all(
+                "SELECT client_id FROM rec_friend WHERE friend_id = %s AND is_delete = 0", (owner_id,)
+            )
+        except Exception as e:
+            # запись уже изменена - ошибка поиска связанных клиентов не должна сорвать ответ
+            await self.main.log.log_info('mysql', 'Ошибка поиска клиентов для сброса записей', str(e), True)
+            rows = []
+        self.invalidate_bookings(owner_id, *client_ids, *(row[0] for row in rows))
+
+    async def get_write_owner(self, write_id):
+        """
+        client_id владельца записи rec_write (None, если запись не найдена).
+        """
+        row = await self.main.mysql.fetch_one("SELECT client_id FROM rec_write WHERE id = %s", (write_id,))
+        return row[0] if row else None
+
+    def history_limit(self) -> int:
+        """
+        Размер окна истории: DIALOG_SAVE пар + пара для summary.
+        """
+        value = self.main.env.get('DIALOG_SAVE')
+        value_int = int(value) if value is not None else None
+        return (value_int + 1) * 2
+
     async def clear_dialog(self, update: Update = None):
 
         # Получаем id клиента
         telegram_user_id = str(update.effective_user.id)
         client_id = await self.get_or_create_client_id(telegram_user_id, update)
         if False: return client_id
-        
-        # Удаляем все сообщения диалога
-        delete_sql = "UPDATE `rec_dialog` SET `is_delete`=1 WHERE client_id = %s"
-        await self.main.mysql.execute(delete_sql, (client_id,))
 
-        # Очищаем summary
-        update_sql = "UPDATE `rec_client` SET summary = NULL WHERE id = %s"
-        await self.main.mysql.execute(update_sql, (client_id,))
+        # Незаписанные сообщения должны попасть в БД до пометки удалёнными
+        if self.dialog:
+            await self.dialog.flush()
+        
+        async with self.main.mysql.transaction() as tx:
+            # Удаляем все сообщения диалога
+            delete_sql = "UPDATE `rec_dialog` SET `is_delete`=1 WHERE client_id = %s"
+            await tx.execute(delete_sql, (client_id,))
+
+            # Очищаем summary
+            update_sql = "UPDATE `rec_client` SET summary = NULL WHERE id = %s"
+            await tx.execute(update_sql, (client_id,))
+
+        ctx = self.contexts.peek(client_id)
+        if ctx is not None:
+            ctx.clear_dialog()
+            self.contexts.update(client_id)
+
+        # сообщения помечены удалёнными и больше не учитываются в лимите
+        self.quota.reset(client_id)
         
         # Возвращает client_id
         return client_id
 
     async def get_or_create_client_id(self, telegram_user_id: str, update: Update = None) -> int:
-        # 1. Пытаемся найти клиента
-        sql = "SELECT id FROM rec_client WHERE tel_id = %s"
-        result = await self.main.mysql.fetch_one(sql, (telegram_user_id,))
-        if result:
-            return result[0]
+        # 1. Ищем клиента в кэше
+        client_id = self.client_ids.get(telegram_user_id)
+        if client_id is not None:
+            return client_id
 
         # 2. Достаём данные из update, если есть
         tel_username = update.effective_user.username if update else None
         tel_name = update.effective_user.full_name if update else None
         tel_first = update.effective_user.first_name if update else None
 
-        # 3. Создаём клиента
-        insert_sql = """
+        # 3. Пока нет уникального ключа по tel_id (миграция 1 не применена), upsert вставил бы
+        #    дубликат - сначала ищем существующего клиента
+        if self.tel_id_unique is None:
+            await self.check_schema()
+        if not self.tel_id_unique:
+            row = await self.main.mysql.fetch_one(
+                "SELECT id FROM rec_client WHERE tel_id = %s ORDER BY id LIMIT 1", (telegram_user_id,)
+            )
+            if row:
+                self.client_ids.set(telegram_user_id, row[0])
+                return row[0]
+
+        # 4. Создаём клиента или получаем ID существующего (уникальный ключ по tel_id)
+        sql = """
             INSERT INTO rec_client (tel_id, tel_username, tel_name, tel_first)
             VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE id = LAST_INSERT_ID(id)
         """
-        await self.main.mysql.execute(insert_sql, (
+        client_id = await self.main.mysql.execute_return_id(sql, (
             telegram_user_id,
             tel_username,
             tel_name,
             tel_first
         ))
-
-        # 4. Получаем ID
-        result = await self.main.mysql.fetch_one(sql, (telegram_user_id,))
-        return result[0]
+        self.client_ids.set(telegram_user_id, client_id)
+        return client_id
 
     async def get_client_history(self, client_id: int):
-        sql = "SELECT role, content FROM rec_dialog WHERE client_id = %s AND `is_delete`=0 ORDER BY `time` ASC"
-        rows = await self.main.mysql.fetch_all(sql, (client_id,))
-        value = self.main.env.get('DIALOG_SAVE')
-        value_int = int(value) if value is not None else None
-        extract = (value_int + 1) * 2
+        extract = self.history_limit()
+        ctx = self.get_context(client_id)
+
+        if ctx.history is None:
+            # Выбираем только последние `extract` сообщений и разворачиваем в хронологический порядок
+            if self.dialog:
+                rows, pending = await self.dialog.read(
+                    client_id, lambda: self.main.mysql.fetch_all(CLIENT_HISTORY, (client_id, extract))
+                )
+                rows = (list(rows[::-1]) + [(r['role'], r['content']) for r in pending])[-extract:]
+            else:
+                rows = await self.main.mysql.fetch_all(CLIENT_HISTORY, (client_id, extract))
+                rows = rows[::-1]
+            ctx.history = [tuple(r) for r in rows]
+            self.contexts.update(client_id)
+        rows = ctx.history
 
         role_map = {0: "user", 1: "assistant"}
-        history = [{"role": role_map.get(role, "user"), "content": content} for role, content in rows[-extract:]]
+        history = [{"role": role_map.get(role, "user"), "content": content} for role, content in rows]
 
         if len(history) >= extract:
             hist_summary = history[:2]
@@ -81,7 +255,7 @@ class Request:
 
         return hist_dialog, hist_summary
 
-    async def save_message(self, client_id: int, role: str, content: str, tokens_in: int = 0, tokens_out: int = 0):
+    async def save_message(self, client_id: int, role: str, content: str, tokens_in: int = 0, tokens_out: int = 0, tokens_cached: int = 0, model: str = None):
         content = str(content)
         role_map = {'user': 0, 'assistant': 1}
         role_int = role_map.get(role, 0)  # по умолчанию 0 (user), если что-то пошло не так
@@ -89,32 +263,62 @@ class Request:
         if role == 'user':
             sql = "INSERT INTO rec_dialog (client_id, role, content) VALUES (%s, %s, %s)"
             params = (client_id, role_int, content)
+            usage = ()
         else:
-            sql = """
-                INSERT INTO rec_dialog (
-                    client_id, role, content,
-                    tokens_in, tokens_out,
-                    price_in, price_out
-                )
-                VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """
-            price_in = self.main.env.get_float('GPT_PRICE_IN')
-            price_out = self.main.env.get_float('GPT_PRICE_OUT')
-            params = (
-                client_id, role_int, content,
-                tokens_in, tokens_out,
-                price_in, price_out
-            )
-        
-        await self.main.mysql.execute(sql, params)
+            # столбец tokens_cached появляется с миграцией 2, до неё не записывается
+            if self.tokens_cached_column is None:
+                await self.check_schema()
+            price_in, price_out = self.router.prices(model)
+            usage = (tokens_in, tokens_out, tokens_cached, price_in, price_out)
+            if self.tokens_cached_column:
+                sql = """
+                    INSERT INTO rec_dialog (
+                        client_id, role, content,
+                        tokens_in, tokens_out, tokens_cached,
+                        price_in, price_out
+                    )
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                """
+                params = (client_id, role_int, content, *usage)
+            else:
+                sql = """
+                    INSERT INTO rec_dialog (
+                        client_id, role, content,
+                        tokens_in, tokens_out,
+                        price_in, price_out
+                    )
+                    VALUES (%s, %s, %s, %s, %s, %s, %s)
+                """
+                params = (client_id, role_int, content, tokens_in, tokens_out, price_in, price_out)
+
+        if self.dialog:
+            await self.dialog.add(client_id, role_int, content, *usage)
+        else:
+            await self.main.mysql.execute(sql, params)
+
+        if role_int == 0:
+            self.quota.increment(client_id)
+
+        ctx = self.contexts.peek(client_id)
+        if ctx is not None:
+            ctx.add_message(role_int, content, self.history_limit())
+            self.contexts.update(client_id)
 
     async def get_today_request_count(self, client_id: int):
-        today = datetime.now().strftime("%Y-%m-%d")
-        sql = """
-            SELECT COUNT(*) FROM rec_dialog
-            WHERE client_id = %s AND role = 0 AND DATE(`time`) = %s AND `is_delete`=0
-        """
-        result = await self.main.mysql.fetch_one(sql, (client_id, today))
+        return await self.quota.count(client_id)
+
+    async def load_today_request_count(self, client_id: int):
+        # Полуоткрытый интервал [сегодня; завтра) вместо DATE(`time`), чтобы работал индекс
+        today = datetime.combine(date.today(), datetime.min.time())
+        tomorrow = today + timedelta(days=1)
+        if self.dialog:
+            result, pending = await self.dialog.read(
+                client_id, lambda: self.main.mysql.fetch_one(TODAY_REQUEST_COUNT, (client_id, today, tomorrow))
+            )
+            unsaved = sum(1 for r in pending if r['role'] == 0 and r['time'] >= today)
+            return (result[0] if result else 0) + unsaved
+
+        result = await self.main.mysql.fetch_one(TODAY_REQUEST_COUNT, (client_id, today, tomorrow))
         return result[0] if result else 0
 
     async def get_system_prompt(self):
@@ -126,10 +330,114 @@ class Request:
                 self._system_prompt = "Ты — ассистент. (system.md не найден)"
         return self._system_prompt
     
+    def get_packer(self) -> ContextPacker:
+        """
+        Упаковщик контекста под модель GPT_MODEL (создаётся при первом использовании).
+        """
+        if self._packer is None:
+            self._packer = ContextPacker(self.main.env.get('GPT_MODEL'))
+        return self._packer
+
+    def build_messages(self, system: str, data: list, bookings: list, history: list, turn: str,
+                       user_content: str, chunks: list, budget: int = 0):
+        """
+        Собирает сообщения промпта. При заданном бюджете токенов записи на приём,
+        история и чанки сокращаются по приоритету (см. ContextPacker).
+        Возвращает (messages, отчёт о сокращениях или None).
+        """
+        report = None
+        if budget:
+            fixed = [{"role": "system", "content": system}] + data + [
+                {"role": "system", "content": turn},
+                {"role": "user", "content": user_content}
+            ]
+            bookings, history, chunks, report = self.get_packer().pack(budget, fixed, bookings, history, chunks)
+
+        # Сначала неизменные для всех блоки (system.md, справочники),
+        # затем данные клиента, история и данные текущего хода
+        messages = [{"role": "system", "content": system}] + data + bookings + history + [
+            {"role": "system", "content": turn},
+            {"role": "user", "content": user_content + "\n\n".join(chunks)}
+        ]
+        return messages, report
+
+    def get_demo_data(self) -> list:
+        """
+        Демонстрационный пример адресов и расписания (собирается один раз).
+        """
+        if self._demo_data is None:
+            # Исходные данные: адреса
+            self._demo_data = [
+                {
+                    "role": "assistant",
+                    "content": """Записать на прием можно по следующим адресам:\n
+                        'addresses': [
+                            'address_id': '11', 'address_name': 'г. Москва, ул. Академика Королёва, д. 15',
+                            'address_id': '12', 'address_name': 'г. Санкт-Петербург, Невский проспект, д. 28',
+                        ],                    
+                    """
+                },
+                {"role": "user", "content": """
+                    Хорошо. Когда будет предлагать мне выбрать адрес - перечисли все адреса, каждый с новой строки и дефиса!\nНа какое время можно записаться в Санкт-Петербурге?
+                """},
+                {'role': 'assistant', 'content': 'В Санкт-Петербурге (address_id=12) можно записаться с 09:00 до 20:00 с интервалом 1 час на 15.10.2025 и 22.10.2025, вот более подробно:' + """
+                        {"event_id": "146", "date":"2025-10-15", "time":"09:00"},
+                        {"event_id": "147", "date":"2025-10-15", "time":"10:00"},
+                        {"event_id": "148", "date":"2025-10-15", "time":"11:00"},
+                        {"event_id": "149", "date":"2025-10-15", "time":"12:00"},
+                        {"event_id": "150", "date":"2025-10-15", "time":"13:00"},
+                        {"event_id": "151", "date":"2025-10-15", "time":"14:00"},
+                        {"event_id": "152", "date":"2025-10-15", "time":"15:00"},
+                        {"event_id": "153", "date":"2025-10-15", "time":"16:00"},
+                        {"event_id": "154", "date":"2025-10-15", "time":"17:00"},
+                        {"event_id": "155", "date":"2025-10-15", "time":"18:00"},
+                        {"event_id": "156", "date":"2025-10-15", "time":"19:00"},
+                        {"event_id": "157", "date":"2025-10-15", "time":"20:00"},                    
+                        {"event_id": "158", "date":"2025-10-22", "time":"09:00"},
+                        {"event_id": "159", "date":"2025-10-22", "time":"10:00"},
+                        {"event_id": "160", "date":"2025-10-22", "time":"11:00"},
+                        {"event_id": "161", "date":"2025-10-22", "time":"12:00"},
+                        {"event_id": "162", "date":"2025-10-22", "time":"13:00"},
+                        {"event_id": "163", "date":"2025-10-22", "time":"14:00"},
+                        {"event_id": "164", "date":"2025-10-22", "time":"15:00"},
+                        {"event_id": "165", "date":"2025-10-22", "time":"16:00"},
+                        {"event_id": "166", "date":"2025-10-22", "time":"17:00"},
+                        {"event_id": "167", "date":"2025-10-22", "time":"18:00"},
+                        {"event_id": "168", "date":"2025-10-22", "time":"19:00"},
+                        {"event_id": "169", "date":"2025-10-22", "time":"20:00"},                    
+                """},
+                {"role": "user", "content": "На какое время можно записаться в Мослве?"},            
+                {'role': 'assistant', 'content': 'В Москве (address_id=11) можно записаться с 10:00 до 16:00 с интервалом 1 час на 20.10.2025 и 30.10.2025, вот более подробно:' + """
+                        {"event_id": "170", "date":"2025-10-20", "time":"10:00"},
+                        {"event_id": "171", "date":"2025-10-20", "time":"11:00"},
+                        {"event_id": "172", "date":"2025-10-20", "time":"12:00"},
+                        {"event_id": "173", "date":"2025-10-20", "time":"13:00"},
+                        {"event_id": "174", "date":"2025-10-20", "time":"14:00"},
+                        {"event_id": "175", "date":"2025-10-20", "time":"15:00"},                    
+                        {"event_id": "176", "date":"2025-10-20", "time":"16:00"},
+                        {"event_id": "177", "date":"2025-10-30", "time":"10:00"},
+                        {"event_id": "178", "date":"2025-10-30", "time":"11:00"},
+                        {"event_id": "179", "date":"2025-10-30", "time":"12:00"},
+                        {"event_id": "180", "date":"2025-10-30", "time":"13:00"},
+                        {"event_id": "181", "date":"2025-10-30", "time":"14:00"},
+                        {"event_id": "182", "date":"2025-10-30", "time":"15:00"},                    
+                        {"event_id": "183", "date":"2025-10-30", "time":"16:00"},                     
+                """},
+                {"role": "user", "content": "Какой врач принимает в Москве?"},                        
+                {"role": "assistant", "content": "В Москве (address_id=11) проводит прием {'doctor_id': 1, 'fio': 'Соколов Иван Викторович', 'desc': 'Врач ЛФК, стаж 19 лет'}"},
+                {"role": "user", "content": "Какой врач принимает в Санкт-Петербурге?"},                        
+                {"role": "assistant", "content": "В Санкт-Петербурге (address_id=12) проводит прием {'doctor_id': 2, 'fio': 'Карчевский Вадим Вадимович', 'desc': 'Невролог, стаж 9 лет'}"},
+            ]
+
+        return self._demo_data
+
     async def get_user_summary(self, client_id: int) -> str:
-        sql = "SELECT summary FROM rec_client WHERE id = %s"
-        result = await self.main.mysql.fetch_one(sql, (client_id,))
-        return result[0] if result and result[0] is not None else ""        
+        ctx = self.get_context(client_id)
+        if ctx.summary is None:
+            result = await self.main.mysql.fetch_one(USER_SUMMARY, (client_id,))
+            ctx.summary = result[0] if result and result[0] is not None else ""
+            self.contexts.update(client_id)
+        return ctx.summary
 
     async def update_user_summary(self, client_id: int, summary: str):
         sql = """
@@ -137,7 +445,12 @@ class Request:
             SET summary = %s
             WHERE id = %s
         """
-        await self.main.mysql.execute(sql, (summary, client_id))    
+        await self.main.mysql.execute(sql, (summary, client_id))
+
+        ctx = self.contexts.peek(client_id)
+        if ctx is not None:
+            ctx.summary = summary
+            self.contexts.update(client_id)
 
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         telegram_user_id = str(update.effective_user.id)
@@ -145,116 +458,128 @@ class Request:
         user = update.message.from_user
         username = user.username if user.username else f"{user.first_name} {user.last_name or ''}".strip()
         
+        timings = {}
+        started = time.perf_counter()
+        db_timeout = self.main.env.get_float('STAGE_TIMEOUT', 3.0)
+        use_reference = self.main.env.get_int('PROMPT_REFERENCE')
+
+        # Поиск чанков зависит только от текста сообщения - запускаем сразу.
+        # Эмбеддинг вопроса при включённом кэше ответов вычисляется один раз для обоих
+        vector_task = asyncio.create_task(self.main.chunks.embed_query(user_input)) if self.answers.enabled else None
+        chunks_task = asyncio.create_task(self.stage(
+            'chunks', self.find_chunks(user_input, vector_task),
+            self.main.env.get_float('RETRIEVAL_TIMEOUT', 5.0), [], timings
+        ))
+
         # Получаем или создаём внутренний ID клиента
-        client_id = await self.get_or_create_client_id(telegram_user_id, update)
-        
-        # Добавление ответа пользователя в Google Sheet
-        await self.save_to_google_sheet(client_id, username, 'user', user_input)        
-
-        # Лимит запросов
-        if telegram_user_id not in self.main.env.get('UNLIMITED_USERS'):
-            count = await self.get_today_request_count(client_id)
-            if count >= 20:
-                await update.message.reply_text("Вы достигли дневного лимита в 20 запросов. Попробуйте завтра.")
+        try:
+            client_id = await self.stage(
+                'client_id', self.get_or_create_client_id(telegram_user_id, update),
+                db_timeout, None, timings, required=True
+            )
+        except BaseException:
+            chunks_task.cancel()
+            if vector_task:
+                vector_task.cancel()
+            raise
+
+        # Независимые этапы сборки промпта выполняются параллельно
+        (
+            _, exceeded, (hist_dialog, hist_summary), system, summary,
+            write_me_dict, write_friend_dict, reference
+        ) = await asyncio.gather(
+            # Добавление ответа пользователя в Google Sheet
+            self.stage('google', self.save_to_google_sheet(client_id, username, 'user', user_input), db_timeout, None, timings),
+            # Лимит запросов
+            self.stage('quota', self.check_quota(telegram_user_id, client_id), db_timeout, False, timings),
+            # История
+            self.stage('history', self.get_client_history(client_id), db_timeout, ([], []), timings),
+            # Роль system
+            self.stage('system', self.get_system_prompt(), db_timeout, "Ты — ассистент. (system.md не найден)", timings),
+            # Текущая summary (None - не загружена: новая summary модели в этом ходе не сохраняется)
+            self.stage('summary', self.get_user_summary(client_id), db_timeout, None, timings),
+            # Данные о записи на прием (None - не загружены, записи неизвестны)
+            self.stage('write_me', self.get_write_recept(client_id), db_timeout, None, timings),
+            self.stage('write_friends', self.get_write_recept_friends(client_id), db_timeout, None, timings),
+            # Справочники
+            self.stage('reference', self.main.reference.get_fragment(), db_timeout, None, timings) if use_reference else asyncio.sleep(0)
+        )
+
+        if exceeded:
+            chunks_task.cancel()
+            if vector_task:
+                vector_task.cancel()
+            await update.message.reply_text(f"Вы достигли дневного лимита в {self.quota.limit} запросов. Попробуйте завтра.")
+            return
+
+        # Кэш ответов. Готовый ответ не подходит клиенту с записями на приём (незагруженные - тоже).
+        # Сохраняется ответ только хода без личных данных в промпте: пустая summary (ФИО, жалобы)
+        # и ни одного сообщения клиента в истории (приветствие /start - не личное)
+        bookings = write_me_dict is None or write_friend_dict is None or bool(write_me_dict or write_friend_dict)
+        conversation = summary is None or bool(summary) or any(m['role'] == 'user' for m in hist_summary + hist_dialog)
+        cacheable = self.answers.eligible(user_input, bookings)
+        storable = cacheable and not conversation
+        vector = None
+        if cacheable:
+            vector = await self.get_vector(vector_task)
+            answer, score = self.answers.lookup(user_input, vector)
+            if answer is not None:
+                chunks_task.cancel()
+                await self.main.log.log_info('telegram', 'Ответ из кэша', {
+                    'score': round(score, 4), 'ms': round((time.perf_counter() - started) * 1000, 1)
+                })
+                await self.save_message(client_id, "user", user_input)
+                await self.save_to_google_sheet(client_id, username, 'assistant', answer)
+                await self.save_message(client_id, "assistant", answer)
+                await update.message.reply_text(answer)
                 return
 
-        # История
-        hist_dialog, hist_summary = await self.get_client_history(client_id)
-        
-        # Роль system
-        system = await self.get_system_prompt()
-        
+        # Получение чанков
+        chunks_list = await chunks_task
+        timings['total'] = round((time.perf_counter() - started) * 1000, 1)
+        await self.main.log.log_info('telegram', 'Сборка промпта, мс', timings)
+
         # Данные из БД
         # md_data = await self.generate_md_data(client_id)
         # system += "\n\n---\n\n📚 Актуальные данные из БД:\n\n" + md_data        
 
-        # История диалога        
-        summary = await self.get_user_summary(client_id)
+        # Данные текущего хода: в конце промпта, чтобы не ломать кэширование общего префикса
         hist_summary_str = "\n".join(f"{m['role']}: {m['content']}" for m in hist_summary)
         now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        system = system + (
-            f"\n\n🕒 Текущая дата и время: {now}"
-            f"\n\n📌 Текущая информаци для summary:\n{summary}\n\n"
+        turn = (
+            f"🕒 Текущая дата и время: {now}"
+            f"\n\n📌 Текущая информаци для summary:\n{summary or ''}\n\n"
             f"📌 Последняя пара сообщений для включения в summary:\n{hist_summary_str}"
         )
+        if self.tools:
+            turn += "\n\n🛠 Действия (запись, перенос, отмена, обращение к оператору) выполняй вызовом инструментов, поле function_call оставляй null."
         
-        # Исходные данные: адреса
-        data = [
-            {
-                "role": "assistant",
-                "content": """Записать на прием можно по следующим адресам:\n
-                    'addresses': [
-                        'address_id': '11', 'address_name': 'г. Москва, ул. Академика Королёва, д. 15',
-                        'address_id': '12', 'address_name': 'г. Санкт-Петербург, Невский проспект, д. 28',
-                    ],                    
-                """
-            },
-            {"role": "user", "content": """
-                Хорошо. Когда будет предлагать мне выбрать адрес - перечисли все адреса, каждый с новой строки и дефиса!\nНа какое время можно записаться в Санкт-Петербурге?
-            """},
-            {'role': 'assistant', 'content': 'В Санкт-Петербурге (address_id=12) можно записаться с 09:00 до 20:00 с интервалом 1 час на 15.10.2025 и 22.10.2025, вот более подробно:' + """
-                    {"event_id": "146", "date":"2025-10-15", "time":"09:00"},
-                    {"event_id": "147", "date":"2025-10-15", "time":"10:00"},
-                    {"event_id": "148", "date":"2025-10-15", "time":"11:00"},
-                    {"event_id": "149", "date":"2025-10-15", "time":"12:00"},
-                    {"event_id": "150", "date":"2025-10-15", "time":"13:00"},
-                    {"event_id": "151", "date":"2025-10-15", "time":"14:00"},
-                    {"event_id": "152", "date":"2025-10-15", "time":"15:00"},
-                    {"event_id": "153", "date":"2025-10-15", "time":"16:00"},
-                    {"event_id": "154", "date":"2025-10-15", "time":"17:00"},
-                    {"event_id": "155", "date":"2025-10-15", "time":"18:00"},
-                    {"event_id": "156", "date":"2025-10-15", "time":"19:00"},
-                    {"event_id": "157", "date":"2025-10-15", "time":"20:00"},                    
-                    {"event_id": "158", "date":"2025-10-22", "time":"09:00"},
-                    {"event_id": "159", "date":"2025-10-22", "time":"10:00"},
-                    {"event_id": "160", "date":"2025-10-22", "time":"11:00"},
-                    {"event_id": "161", "date":"2025-10-22", "time":"12:00"},
-                    {"event_id": "162", "date":"2025-10-22", "time":"13:00"},
-                    {"event_id": "163", "date":"2025-10-22", "time":"14:00"},
-                    {"event_id": "164", "date":"2025-10-22", "time":"15:00"},
-                    {"event_id": "165", "date":"2025-10-22", "time":"16:00"},
-                    {"event_id": "166", "date":"2025-10-22", "time":"17:00"},
-                    {"event_id": "167", "date":"2025-10-22", "time":"18:00"},
-                    {"event_id": "168", "date":"2025-10-22", "time":"19:00"},
-                    {"event_id": "169", "date":"2025-10-22", "time":"20:00"},                    
-            """},
-            {"role": "user", "content": "На какое время можно записаться в Мослве?"},            
-            {'role': 'assistant', 'content': 'В Москве (address_id=11) можно записаться с 10:00 до 16:00 с интервалом 1 час на 20.10.2025 и 30.10.2025, вот более подробно:' + """
-                    {"event_id": "170", "date":"2025-10-20", "time":"10:00"},
-                    {"event_id": "171", "date":"2025-10-20", "time":"11:00"},
-                    {"event_id": "172", "date":"2025-10-20", "time":"12:00"},
-                    {"event_id": "173", "date":"2025-10-20", "time":"13:00"},
-                    {"event_id": "174", "date":"2025-10-20", "time":"14:00"},
-                    {"event_id": "175", "date":"2025-10-20", "time":"15:00"},                    
-                    {"event_id": "176", "date":"2025-10-20", "time":"16:00"},
-                    {"event_id": "177", "date":"2025-10-30", "time":"10:00"},
-                    {"event_id": "178", "date":"2025-10-30", "time":"11:00"},
-                    {"event_id": "179", "date":"2025-10-30", "time":"12:00"},
-                    {"event_id": "180", "date":"2025-10-30", "time":"13:00"},
-                    {"event_id": "181", "date":"2025-10-30", "time":"14:00"},
-                    {"event_id": "182", "date":"2025-10-30", "time":"15:00"},                    
-                    {"event_id": "183", "date":"2025-10-30", "time":"16:00"},                     
-            """},
-            {"role": "user", "content": "Какой врач принимает в Москве?"},                        
-            {"role": "assistant", "content": "В Москве (address_id=11) проводит прием {'doctor_id': 1, 'fio': 'Соколов Иван Викторович', 'desc': 'Врач ЛФК, стаж 19 лет'}"},
-            {"role": "user", "content": "Какой врач принимает в Санкт-Петербурге?"},                        
-            {"role": "assistant", "content": "В Санкт-Петербурге (address_id=12) проводит прием {'doctor_id': 2, 'fio': 'Карчевский Вадим Вадимович', 'desc': 'Невролог, стаж 9 лет'}"},
-        ]
+        if reference:
+            # Актуальные адреса, специалисты и расписание из кэша справочников
+            data = [{"role": "assistant", "content": reference}]
+        else:
+            data = self.get_demo_data()
         
         # Данные о записи на прием
-        write_me_dict = await self.get_write_recept(client_id)
+        # (не загрузились - модель не должна считать, что записей нет, и записывать повторно)
+        unknown = 'Данные о записях на прием сейчас недоступны, новую запись не оформляй.'
+        if write_me_dict is None:
+            write_me_text = unknown
+        else:
+            write_me_text = f'Вы записаны на прием:\n{write_me_dict}' if write_me_dict else 'Вы пока не записаны на прием!'
+        if write_friend_dict is None:
+            write_friend_text = unknown
+        else:
+            write_friend_text = f'Вами записаны на прием:\n{write_friend_dict}' if write_friend_dict else 'Вами никто не записан на прием!'
         write_me_current = [
-            {'role': 'assistant', 'content': f'Вы записаны на прием:\n{write_me_dict}' if write_me_dict else 'Вы пока не записаны на прием!'},
+            {'role': 'assistant', 'content': write_me_text},
             {'role': 'user', 'content': 'Кто-то из моих друзей, родственников, знакомых записаны на прием?'}
         ]
-        write_friend_dict = await self.get_write_recept_friends(client_id)
         write_me_current += [
-            {'role': 'assistant', 'content': f'Вами записаны на прием:\n{write_friend_dict}' if write_friend_dict else 'Вами никто не записан на прием!'},
+            {'role': 'assistant', 'content': write_friend_text},
             {'role': 'user', 'content': 'Понял'}
         ]        
         
-        # Получение чанков
-        chunks_text = await self.main.chunks.find_local(user_input)
         '''
         chunks_text = 'Отзыв от Анжелы 15 лет - круто было'
         chunks_role = [
@@ -263,32 +588,97 @@ class Request:
         ]
         '''
 
-        # Сборка промпта
-        messages = [{"role": "system", "content": system}] + data + write_me_current + hist_dialog + [
-            {"role": "user", "content": f"Ответь строго в JSON формате. Вот сообщение пользователя: {user_input}\n\nКонтекст из базы знаний (чанки): {chunks_text}"}
-        ]
+        # Сборка промпта (с учётом бюджета токенов)
+        user_content = f"Ответь строго в JSON формате. Вот сообщение пользователя: {user_input}\n\nКонтекст из базы знаний (чанки): "
+        messages, report = self.build_messages(
+            system, data, write_me_current, hist_dialog, turn, user_content, chunks_list,
+            self.main.env.get_int('PROMPT_TOKEN_BUDGET')
+        )
+        if report and report['cut']:
+            await self.main.log.log_info('telegram', 'Контекст сокращён до бюджета токенов', report)
 
         # Сохраняем пользовательское сообщение
         await self.save_message(client_id, "user", user_input)
 
+        # Потоковый режим: ответ показывается пользователю по мере генерации
+        reply = StreamMessage(self.main, update, self.main.env.get_float('STREAM_EDIT_INTERVAL', 1.0)) \
+            if self.main.env.get_int('GPT_STREAM') else None
+
+        # Дедлайн хода: общий для всех вызовов модели (с повторами и эскалацией)
+        deadline = time.monotonic() + self.main.env.get_float('GPT_TURN_DEADLINE', 45.0)
+        model = None
         try:
-            tokens_in = tokens_out = 0
-            response = await self.main.gpt.request(
-                messages=messages,
-                model=self.main.env.get('GPT_MODEL'),
-                format={"type": "json_object"},
-                temperature=0.5
-            )
+            tokens_in = tokens_out = tokens_cached = 0
+            model, reason = self.router.route(user_input, summary or '', hist_dialog)
+            route = {'model': model, 'reason': reason}
+            llm_started = time.perf_counter()
+            response = None
+            try:
+                response = await self.complete(messages, model, reply, self.tools, deadline)
+                problem = self.router.validate(response) if model != self.router.strong else None
+            except LLMError as e:
+                # дедлайн хода и открытый предохранитель общие для обеих моделей
+                if model == self.router.strong or e.reason in ('deadline', 'circuit'):
+                    raise
+                problem = 'error'
+            if problem:
+                # быстрая модель не справилась - повторяем на основной;
+                # токены неудачного ответа тоже входят в стоимость хода
+                self.router.escalations += 1
+                tokens_in, tokens_out, tokens_cached = self.usage_tokens(response)
+                route.update(
+                    escalated=problem, fast_ms=round((time.perf_counter() - llm_started) * 1000, 1),
+                    fast_tokens=[tokens_in, tokens_out, tokens_cached]
+                )
+                model = self.router.strong
+                response = await self.complete(messages, model, reply, self.tools, deadline)
+            route['llm_ms'] = round((time.perf_counter() - llm_started) * 1000, 1)
+            await self.main.log.log_info('router', 'Выбор модели', route)
             await self.main.log.log_info('telegram', 'Запрос в OpenAI', messages, True)
             await self.main.log.log_info('telegram', 'Получен ответ от OpenAI', response, True)
-            tokens_in = getattr(response.usage, "prompt_tokens", 0)
-            tokens_out = getattr(response.usage, "completion_tokens", 0)            
-            content = response.choices[0].message.content.strip()
-            data = json.loads(content)
-            answer = data.get("answer", "Извините, я не понял.")
-            summary = data.get("summary", "")
-            if summary != '':
-                await self.update_user_summary(client_id, summary)           
+            usage = self.usage_tokens(response)
+            tokens_in, tokens_out, tokens_cached = tokens_in + usage[0], tokens_out + usage[1], tokens_cached + usage[2]
+            message = response.choices[0].message
+
+            # Режим инструментов: независимые вызовы выполняются параллельно,
+            # затем (если модель не дала ответ вместе с вызовами) запрашивается ответ с их результатами
+            tool_calls = getattr(message, 'tool_calls', None) or []
+            calls = [(call.function.name, self.parse_tool_arguments(call.function.arguments)) for call in tool_calls]
+            results = await self.run_calls(calls, client_id, update, context) if calls else []
+            if calls and not self.has_answer(message.content):
+                followup = messages + [{
+                    "role": "assistant",
+                    "content": message.content or None,
+                    "tool_calls": [
+                        {"id": call.id, "type": "function", "function": {"name": call.function.name, "arguments": call.function.arguments}}
+                        for call in tool_calls
+                    ]
+                }] + [
+                    {"role": "tool", "tool_call_id": call.id, "content": json.dumps(result, ensure_ascii=False, default=str)}
+                    for call, (_, result, _) in zip(tool_calls, results)
+                ]
+                try:
+                    response = await self.complete(followup, model, reply, deadline=deadline)
+                    usage = self.usage_tokens(response)
+                    tokens_in, tokens_out, tokens_cached = tokens_in + usage[0], tokens_out + usage[1], tokens_cached + usage[2]
+                    message = response.choices[0].message
+                except LLMError as e:
+                    # действия уже выполнены: ответ собирается из их результатов (повтор записал бы ещё раз)
+                    await self.main.log.log_info("OpenAI", "Ошибка ответа после вызова функций", {"reason": e.reason, "error": str(e)}, True)
+                    message = None
+
+            content = (message.content or '').strip() if message else ''
+            try:
+                data = json.loads(content)
+            except ValueError:
+                if not results:
+                    raise
+                await self.main.log.log_info("OpenAI", "Ответ после вызова функций не разобран", content, True)
+                data = {}
+            answer = data.get("answer", "" if results else "Извините, я не понял.")
+            new_summary = data.get("summary", "")
+            if new_summary != '' and summary is not None:
+                await self.update_user_summary(client_id, new_summary)           
             intent = data.get("intent", "")
             function_call = data.get("function_call", "")                  
             
@@ -303,70 +693,189 @@ class Request:
                 if data_info != '':
                     answer += '\n\n---' + data_info
                 
-            # Вызов функций
-            if function_call:
+            # Вызов функций из строки function_call (текстовый режим)
+            if function_call and not calls:
                 try:
                     # Разбиваем строку на отдельные вызовы
-                    calls = [fc.strip() for fc in function_call.split('),') if fc.strip()]
-                    if not calls:
+                    parts = [fc.strip() for fc in function_call.split('),') if fc.strip()]
+                    if not parts:
                         raise ValueError("Невозможно распарсить function_call")
 
-                    for i, call in enumerate(calls):
+                    for call in parts:
                         # Добавляем ')' обратно, если она была удалена при split
                         if not call.endswith(')'):
                             call += ')'
+                        calls.append(self.parse_function_call(call))
 
-                        func_name, func_args = self.parse_function_call(call)
-
-                        # Добавляем client_id, если его нет
-                        if func_name != "notify_operator":
-                            func_args.setdefault('client_id', client_id)
-                        
-                        # Добавляем update и context для 'notify_operator'
-                        if func_name == "notify_operator":
-                            func_args.setdefault('update', update)
-                            func_args.setdefault('context', context)
-
-                        # Вызываем функцию
-                        result = await getattr(self, func_name)(**func_args)
-
-                        # Ответ в зависимости от вызванной функции
-                        if func_name == "write_recept":
-                            answer += f"\n\n✅ Вы записаны!"
-                            await self.clear_dialog(update)
-                        elif func_name == "write_me_update":
-                            answer += f"\n\n🔄 Запись перенесена!"
-                            await self.clear_dialog(update)
-                        elif func_name == "write_me_cancel":
-                            answer += f"\n\n🚫 Запись отменена!"
-                            await self.clear_dialog(update)
-                        elif func_name == "write_recept_friend":
-                            answer += f"\n\n✅ Запись выполнена!"
-                            await self.clear_dialog(update)
-                        elif func_name == "write_friend_update":
-                            answer += f"\n\n🔄 Запись перенесена!"
-                            await self.clear_dialog(update)
-                        elif func_name == "write_friend_cancel":
-                            answer += f"\n\n🚫 Запись отменена!"
-                            await self.clear_dialog(update)
-                        elif func_name == "notify_operator":
-                            answer += f"\n\n👨‍⚕️ Ваше обращение направлено в чат поддержки! Вам ответит первый освободившийся оператор"                                                    
-                        else:
-                            answer += f"\n\n⚠️ Неизвестная функция: {func_name}"
-
+                    results = await self.run_calls(calls, client_id, update, context)
                 except Exception as fc_err:
                     await self.main.log.log_info("telegram", "Ошибка вызова function_call", str(fc_err), True)
                     answer += "\n\n⚠️ Ошибка при выполнении действия."      
+
+            # Ответ в зависимости от вызванных функций; после изменения записей диалог очищается один раз
+            answer = "\n\n".join(([answer] if answer else []) + [call_reply for _, _, call_reply in results])
+            if any(ok and name in CLEAR_DIALOG for (name, _), (ok, _, _) in zip(calls, results)):
+                await self.clear_dialog(update)
+            if storable and not calls and not function_call and "answer" in data:
+                # Ответ без вызова функций и личных данных - в кэш ответов
+                self.answers.store(user_input, vector, answer)
+        except LLMError as e:
+            await self.main.log.log_info("OpenAI", "Ошибка вызова модели", {"reason": e.reason, "error": str(e)}, True)
+            answer = self.LLM_ERROR_REPLIES.get(e.reason, self.LLM_ERROR_REPLIES['error'])
         except Exception as e:
             await self.main.log.log_info("OpenAI", "Ошибка в обработке", str(e), True)
             answer = "Извините, не удалось обработать ваш запрос. Пожалуйста, повторите позже."
 
-        # Сохраняем ответ
-        await self.save_message(client_id, "assistant", answer, tokens_in, tokens_out)
+        # Сохраняем ответ (ошибка записи не должна оставить пользователя без ответа)
+        try:
+            await self.save_message(client_id, "assistant", answer, tokens_in, tokens_out, tokens_cached, model)
+        except Exception as e:
+            await self.main.log.log_info("mysql", "Ошибка сохранения ответа", str(e), True)
 
         # Отправка пользователю
-        await update.message.reply_text(answer)
+        if reply:
+            await reply.finish(answer)
+        else:
+            await update.message.reply_text(answer)
         
+    async def complete(self, messages: list, model: str, reply: StreamMessage = None, tools: list = None, deadline: float = None):
+        """
+        Запрос ответа модели: потоковый (с показом в `reply`) или обычный.
+        """
+        if reply:
+            return await self.main.gpt.request_stream(
+                messages=messages,
+                on_answer=reply.push,
+                model=model,
+                format={"type": "json_object"},
+                temperature=0.5,
+                tools=tools,
+                deadline=deadline
+            )
+        return await self.main.gpt.request(
+            messages=messages,
+            model=model,
+            format={"type": "json_object"},
+            temperature=0.5,
+            tools=tools,
+            deadline=deadline
+        )
+
+    @staticmethod
+    def usage_tokens(response) -> tuple:
+        """
+        Токены запроса: (вход, выход, из кэша промпта).
+        """
+        usage = getattr(response, "usage", None)
+        tokens_in = getattr(usage, "prompt_tokens", 0) or 0
+        tokens_out = getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        tokens_cached = getattr(details, "cached_tokens", 0) or 0
+        return tokens_in, tokens_out, tokens_cached
+
+    @staticmethod
+    def has_answer(content) -> bool:
+        try:
+            return "answer" in json.loads(content or '')
+        except (TypeError, ValueError):
+            return False
+
+    @staticmethod
+    def parse_tool_arguments(arguments):
+        """
+        Аргументы вызова инструмента (JSON) или None, если их не удалось разобрать.
+        """
+        try:
+            args = json.loads(arguments or '{}')
+        except ValueError:
+            return None
+        return args if isinstance(args, dict) else None
+
+    async def run_calls(self, calls: list, client_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE) -> list:
+        """
+        Выполняет вызовы функций [(имя, аргументы)]. Вызовы, изменяющие разные записи,
+        выполняются параллельно, одну и ту же - по порядку.
+        Возвращает [(успех, результат, дополнение к ответу)] в порядке вызовов.
+        """
+        results = [None] * len(calls)
+        groups = {}
+        for i, (name, args) in enumerate(calls):
+            groups.setdefault(call_key(name, args or {}), []).append(i)
+
+        async def run_group(indexes):
+            for i in indexes:
+                results[i] = await self.run_call(*calls[i], client_id, update, context)
+
+        await asyncio.gather(*(run_group(indexes) for indexes in groups.values()))
+        return results
+
+    async def run_call(self, name: str, args: dict, client_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not name or args is None:
+            return False, {"status": "error", "error": "invalid call"}, "⚠️ Ошибка при выполнении действия."
+        if name not in REPLIES:
+            return False, {"status": "error", "error": f"unknown function {name}"}, f"⚠️ Неизвестная функция: {name}"
+
+        args = dict(args)
+        if name == "notify_operator":
+            # Добавляем update и context для 'notify_operator'
+            args.update(update=update, context=context)
+        else:
+            args["client_id"] = client_id
+
+        try:
+            result = await getattr(self, name)(**args)
+        except Exception as e:
+            await self.main.log.log_info("telegram", "Ошибка вызова функции", {"name": name, "error": str(e)}, True)
+            return False, {"status": "error", "error": str(e)}, "⚠️ Ошибка при выполнении действия."
+        return True, result if result is not None else {"status": "ok"}, REPLIES[name]
+
+    async def find_chunks(self, question: str, vector_task=None) -> list:
+        """
+        Поиск чанков по готовому эмбеддингу вопроса (если он вычисляется) или по тексту.
+        """
+        if vector_task is None:
+            return await self.main.chunks.find_local_list(question)
+        # shield: таймаут поиска не должен отменять общий эмбеддинг
+        vector = await asyncio.shield(vector_task)
+        return await self.main.chunks.find_local_list(question, vector)
+
+    async def get_vector(self, vector_task):
+        """
+        Результат общего эмбеддинга вопроса или None при ошибке.
+        """
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(vector_task), self.main.env.get_float('RETRIEVAL_TIMEOUT', 5.0)
+            )
+        except Exception as e:
+            await self.main.log.log_info('telegram', 'Ошибка эмбеддинга вопроса', str(e))
+            return None
+
+    async def stage(self, name, coro, timeout, fallback, timings, required=False):
+        """
+        Этап сборки промпта с ограничением по времени.
+        При ошибке или таймауте возвращает `fallback` (для обязательного этапа - пробрасывает ошибку).
+        Время этапа в мс записывается в `timings[name]`.
+        """
+        started = time.perf_counter()
+        try:
+            return await asyncio.wait_for(coro, timeout)
+        except Exception as e:
+            await self.main.log.log_info('telegram', f'Ошибка этапа {name}', repr(e), True)
+            if required:
+                raise
+            return fallback
+        finally:
+            timings[name] = round((time.perf_counter() - started) * 1000, 1)
+
+    async def check_quota(self, telegram_user_id: str, client_id: int) -> bool:
+        """
+        True, если пользователь исчерпал дневной лимит.
+        """
+        if self.quota.is_unlimited(telegram_user_id):
+            return False
+        return await self.quota.exceeded(client_id)
+
     async def save_to_google_sheet(self, client_id, username, role, answer):
         """
         Формирует строку и отправляет её в Google Sheets
@@ -398,47 +907,19 @@ class Request:
             await self.main.log.log_info('telegram', f"Ошибка при отправке в группу: {e}", {}, True)
                 
     async def generate_md_data(self, client_id: int) -> str:
-        today = datetime.today().date()
-
-        # places
-        sql_places = "SELECT id, text FROM rec_place WHERE is_delete = 0"
-        rows = await self.main.mysql.fetch_all(sql_places)
-        places = {str(r[0]): r[1] for r in rows}  # r[0] = id, r[1] = text
-
-        # masters
-        sql_masters = "SELECT id, fio, `desc` FROM rec_master WHERE is_delete = 0"
-        rows = await self.main.mysql.fetch_all(sql_masters)
-        masters = {
-            str(r[0]): {
-                "fio": r[1],
-                "desc": r[2] or ""
+        # places, masters, events - из кэша справочников
+        await self.main.reference.ensure_loaded()
+        places = self.main.reference.places
+        masters = self.main.reference.masters
+        events = {
+            event_id: {
+                **event,
+                "place_name": places.get(event["place_id"], ""),
+                "master_fio": masters.get(event["master_id"], {}).get("fio", "")
             }
-            for r in rows
+            for event_id, event in self.main.reference.events.items()
         }
 
-        # events - добавляем сортировку по дате и времени в SQL
-        sql_events = """
-            SELECT id, date, TIME_FORMAT(time, '%H:%i') as time_str, place_id, master_id
-            FROM rec_event
-            WHERE is_delete = 0 AND date >= CURDATE()
-            ORDER BY date ASC, time ASC
-        """
-        rows = await self.main.mysql.fetch_all(sql_events)
-
-        events = {}
-        for r in rows:
-            event_id = str(r[0])
-            place_id = str(r[3])
-            master_id = str(r[4])
-            events[event_id] = {
-                "date": r[1].strftime('%Y-%m-%d'),
-                "time": r[2],
-                "place_id": place_id,
-                "place_name": places.get(place_id, ""),
-                "master_id": master_id,                
-                "master_fio": masters.get(master_id, {}).get("fio", "")
-            }
-
         # write_me - фильтр по client_id
         sql_write = """
             SELECT rw.event_id, rw.client_fio, rw.problem, rc.params, re.date
@@ -472,10 +953,11 @@ class Request:
         md += "**write_me:**\n"
         md += json.dumps(write_me, indent=2, ensure_ascii=False) + "\n"
 
-        # Запись в файл (можно асинхронно, но тут синхронно для простоты)
-        filename = 'base/md.md'
-        with open(filename, 'w', encoding='utf-8') as f:
-            f.write(md)
+        # Запись в файл только при изменении, вне цикла событий
+        if md != self._md_data:
+            self._md_data = md
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, Path('base/md.md').write_text, md, 'utf-8')
 
         return md
 
@@ -489,6 +971,7 @@ class Request:
         """
         params = (event_id, client_id, client_fio, problem)
         await self.main.mysql.execute(sql, params)
+        await self.invalidate_bookings_of(client_id)
 
     def format_event(self, event_date: date, event_time: timedelta) -> tuple[str, str]:
         total_seconds = int(event_time.total_seconds())
@@ -499,17 +982,12 @@ class Request:
         return date_str, time_str
         
     async def get_write_recept(self, client_id):
+        ctx = self.get_context(client_id)
+        if ctx.write_me is not None:
+            return ctx.write_me
+
         # write_me - фильтр по client_id
-        sql_write = """
-            SELECT re.place_id, rp.text, re.id, re.date, re.time, rw.client_fio, rw.problem, rm.fio, rm.desc
-            FROM rec_write rw
-            JOIN rec_client rc ON rw.client_id = rc.id
-            JOIN rec_event re ON rw.event_id = re.id
-            JOIN rec_place rp ON re.place_id = rp.id
-            JOIN rec_master rm ON re.master_id = rm.id
-            WHERE rw.is_delete = 0 AND re.date >= CURDATE() AND rw.client_id = %s
-        """
-        rows = await self.main.mysql.fetch_all(sql_write, (client_id,))
+        rows = await self.main.mysql.fetch_all(WRITE_RECEPT, (client_id,))
         write_me = []
         for r in rows:
             date_str, time_str = self.format_event(r[3], r[4])            
@@ -523,7 +1001,9 @@ class Request:
                 "problem": r[6],
                 "Прием проводит": r[7] + '. ' + r[8]
             })       
-        
+
+        ctx.write_me = write_me
+        self.contexts.update(client_id)
         return write_me 
     
     async def write_me(self, event_id: int, client_id: int, client_fio: str, problem: str, had_exam=None):
@@ -536,6 +1016,7 @@ class Request:
         """
         params = (event_id, client_id, client_fio, problem)
         await self.main.mysql.execute(sql, params)
+        await self.invalidate_bookings_of(client_id)
 
         return {
             "status": "ok",
@@ -558,6 +1039,7 @@ class Request:
         """
         params = (event_id, client_id)
         await self.main.mysql.execute(sql, params)
+        await self.invalidate_bookings_of(client_id)
 
         return {
             "status": "ok",
@@ -577,6 +1059,7 @@ class Request:
         """
         params = (client_id, event_id)
         await self.main.mysql.execute(sql, params)
+        await self.invalidate_bookings_of(client_id)
 
         return {
             "status": "ok",
@@ -609,70 +1092,53 @@ class Request:
         - Запись в rec_write от имени друга
         """
 
-        # 1. Поиск друга по полю `fio`
-        sql_find_friend = """
-            SELECT id FROM rec_client
-            WHERE fio = %s AND is_delete = 0
-            LIMIT 1
-        """
-        row = await self.main.mysql.fetch_one(sql_find_friend, (friend_fio,))
-        if row:
-            friend_id = row[0]
-        else:
-            # 2. Создание новой записи в rec_client
-            sql_insert_client = """
-                INSERT INTO rec_client (fio)
-                VALUES (%s)
+        async with self.main.mysql.transaction() as tx:
+            # 1. Поиск друга по полю `fio`
+            sql_find_friend = """
+                SELECT id FROM rec_client
+                WHERE fio = %s AND is_delete = 0
+                LIMIT 1
             """
-            friend_id = await self.main.mysql.execute_return_id(sql_insert_client, (friend_fio,))
+            row = await tx.fetch_one(sql_find_friend, (friend_fio,))
+            if row:
+                friend_id = row[0]
+            else:
+                # 2. Создание новой записи в rec_client
+                sql_insert_client = """
+                    INSERT INTO rec_client (fio)
+                    VALUES (%s)
+                """
+                friend_id = await tx.execute_return_id(sql_insert_client, (friend_fio,))
 
-        # 3. Проверка, существует ли связь client → friend
-        sql_check_friend = """
-            SELECT id FROM rec_friend
-            WHERE client_id = %s AND friend_id = %s AND is_delete = 0
-        """
-        exists = await self.main.mysql.fetch_one(sql_check_friend, (client_id, friend_id))
+            # 3. Проверка, существует ли связь client → friend
+            sql_check_friend = """
+                SELECT id FROM rec_friend
+                WHERE client_id = %s AND friend_id = %s AND is_delete = 0
+            """
+            exists = await tx.fetch_one(sql_check_friend, (client_id, friend_id))
+
+            if not exists:
+                sql_insert_friend = """
+                    INSERT INTO rec_friend (client_id, friend_id, friend_name)
+                    VALUES (%s, %s, %s)
+                """
+                await tx.execute(sql_insert_friend, (client_id, friend_id, friend_name))
 
-        if not exists:
-            sql_insert_friend = """
-                INSERT INTO rec_friend (client_id, friend_id, friend_name)
-                VALUES (%s, %s, %s)
+            # 4. Запись на приём от имени друга
+            sql_write = """
+                INSERT INTO rec_write (event_id, client_id, client_fio, problem)
+                VALUES (%s, %s, %s, %s)
             """
-            await self.main.mysql.execute(sql_insert_friend, (client_id, friend_id, friend_name))
+            await tx.execute(sql_write, (friend_event_id, friend_id, friend_fio, friend_problem))
 
-        # 4. Запись на приём от имени друга
-        sql_write = """
-            INSERT INTO rec_write (event_id, client_id, client_fio, problem)
-            VALUES (%s, %s, %s, %s)
-        """
-        
-        await self.main.mysql.execute(sql_write, (friend_event_id, friend_id, friend_fio, friend_problem))
+        await self.invalidate_bookings_of(friend_id, client_id)
         
     async def get_write_recept_friends(self, client_id):
+        ctx = self.get_context(client_id)
+        if ctx.write_friends is not None:
+            return ctx.write_friends
 
-        sql = """
-            SELECT 
-                re.place_id,
-                rp.text AS place_name,
-                re.id AS event_id,
-                re.date AS event_date,
-                re.time AS event_time,
-                rw.client_fio,
-                rw.problem,
-                rm.fio AS master_fio,
-                rm.`desc` AS master_desc,
-                rw.id,
-                rf.friend_name
-            FROM rec_friend rf
-            JOIN rec_client rc ON rf.client_id = rc.id
-            JOIN rec_write rw ON rw.client_id = rf.friend_id AND rw.is_delete = 0
-            JOIN rec_event re ON rw.event_id = re.id AND re.date >= CURDATE()
-            JOIN rec_place rp ON re.place_id = rp.id
-            JOIN rec_master rm ON re.master_id = rm.id
-            WHERE rf.client_id = %s AND rf.is_delete = 0
-        """
-
-        rows = await self.main.mysql.fetch_all(sql, (client_id,))
+        rows = await self.main.mysql.fetch_all(WRITE_RECEPT_FRIENDS, (client_id,))
         write_friends = []
 
         for r in rows:
@@ -690,6 +1156,8 @@ class Request:
                 "friend_name": r[10]
             })
 
+        ctx.write_friends = write_friends
+        self.contexts.update(client_id)
         return write_friends        
         
     async def write_friend_update(self, client_id: int, friend_write_id, friend_event_id):
@@ -697,6 +1165,8 @@ class Request:
         Перенос записи друга на другой event_id (новый приём).
         Проверка, что друг действительно связан с клиентом.
         """
+        owner_id = await self.get_write_owner(friend_write_id)
+
         # Обновляем event_id записи друга
         sql_update = """
             UPDATE rec_write
@@ -704,6 +1174,7 @@ class Request:
             WHERE id = %s AND is_delete = 0
         """
         await self.main.mysql.execute(sql_update, (friend_event_id, friend_write_id))
+        await self.invalidate_bookings_of(owner_id, client_id)
 
         return {
             "status": "ok",
@@ -715,6 +1186,8 @@ class Request:
         """
         Отмена записи друга (устанавливаем is_delete = 1).
         """
+        owner_id = await self.get_write_owner(friend_write_id)
+
         # Удаляем запись
         sql_cancel = """
             UPDATE rec_write
@@ -722,6 +1195,7 @@ class Request:
             WHERE id = %s AND is_delete = 0
         """
         await self.main.mysql.execute(sql_cancel, (friend_write_id))
+        await self.invalidate_bookings_of(owner_id, client_id)
 
         return {
             "status": "ok",
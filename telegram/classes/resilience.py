@@ -0,0 +1,83 @@
+# telegram/classes/resilience.py
+# Устойчивость вызовов модели: ошибка вызова, предохранитель, окно задержек
+
+import random
+import time
+from collections import deque
+from classes.stats import percentile
+
+class LLMError(Exception):
+    """
+    Вызов модели не удался после всех повторов.
+    `reason`: 'deadline' - истёк срок хода, 'circuit' - сервис помечен недоступным,
+    'empty' - пустой ответ, 'error' - прочие ошибки.
+    """
+
+    def __init__(self, message: str, reason: str = 'error'):
+        super().__init__(message)
+        self.reason = reason
+
+class CircuitBreaker:
+    """
+    Предохранитель: после `threshold` ошибок подряд вызовы отклоняются сразу
+    в течение `reset_timeout` секунд, затем пропускается один пробный вызов.
+    Успех пробного вызова закрывает предохранитель, ошибка - снова открывает.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = 0.0
+        self.rejected = 0
+        self.trips = 0
+
+    def allow(self) -> bool:
+        if self.state == 'closed':
+            return True
+        now = time.monotonic()
+        if now - self.opened_at >= self.reset_timeout:
+            # пробный вызов (повторный - если предыдущий пробный так и не завершился)
+            self.state = 'half_open'
+            self.opened_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        self.state = 'closed'
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.threshold):
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.trips += 1
+
+    def stats(self) -> dict:
+        return {'state': self.state, 'failures': self.failures, 'trips': self.trips, 'rejected': self.rejected}
+
+class LatencyWindow:
+    """
+    Задержки последних успешных вызовов (сек) для расчёта перцентилей.
+    """
+
+    def __init__(self, size: int = 200):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, p: float) -> float:
+        return percentile(self.samples, p)
+
+    def __len__(self):
+        return len(self.samples)
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """
+    Экспоненциальная задержка перед повтором со случайным разбросом («full jitter»).
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,99 @@
+# telegram/classes/router.py
+# Выбор модели для хода: быстрая для простых реплик, основная для сложных
+
+import json
+
+class ModelRouter:
+    """
+    Маршрутизация запросов между основной моделью (GPT_MODEL) и быстрой (GPT_MODEL_FAST)
+    по локальным признакам: длина сообщения, ключевые слова, этап диалога
+    (запись на приём в последнем ответе ассистента или в summary).
+    Ответ быстрой модели проверяется; при ошибке вызова (LLMError), невалидном JSON или отсутствии
+    обязательных ключей запрос повторяется на основной модели.
+    Без GPT_MODEL_FAST все запросы идут в основную модель.
+    """
+
+    # слова, после которых вероятен function_call или нужно рассуждение
+    STRONG_WORDS = (
+        'запис', 'перенес', 'перенос', 'отмен', 'оператор', 'друг', 'родствен', 'знаком',
+        'жалоб', 'почему', 'объясн', 'сравн', 'посовет'
+    )
+
+    # признаки этапа записи на приём
+    BOOKING_WORDS = ('запис', 'перенес', 'перенос', 'отмен', 'подтверд', 'address_id', 'event_id')
+
+    REQUIRED_KEYS = ('answer', 'summary')
+
+    def __init__(self, main):
+        self.main = main
+        self.strong = self.main.env.get('GPT_MODEL')
+        self.fast = self.main.env.get('GPT_MODEL_FAST') or None
+        self.max_chars = self.main.env.get_int('ROUTER_MAX_CHARS', 300)
+        self.short_chars = self.main.env.get_int('ROUTER_SHORT_CHARS', 30)
+
+        self.routed = {}
+        self.escalations = 0
+
+    def route(self, user_input: str, summary: str = '', history: list = None):
+        """
+        Возвращает (модель, причина выбора).
+        """
+        if not self.fast or self.fast == self.strong:
+            return self.count(self.strong, 'single')
+
+        text = user_input.lower()
+        if len(text) > self.max_chars:
+            return self.count(self.strong, 'long')
+        if any(word in text for word in self.STRONG_WORDS):
+            return self.count(self.strong, 'keywords')
+
+        # короткий ответ («да», номер времени) на этапе записи ведёт к вызову функции
+        if len(text) <= self.short_chars:
+            last = next((m['content'] for m in reversed(history or []) if m['role'] == 'assistant'), '')
+            if self.is_booking(last) or self.is_booking(summary):
+                return self.count(self.strong, 'booking_stage')
+
+        return self.count(self.fast, 'simple')
+
+    def is_booking(self, text: str) -> bool:
+        text = (text or '').lower()
+        return any(word in text for word in self.BOOKING_WORDS)
+
+    def count(self, model: str, reason: str):
+        self.routed[model] = self.routed.get(model, 0) + 1
+        return model, reason
+
+    def validate(self, response):
+        """
+        Проверяет ответ модели: None, если он пригоден, иначе причина («error», «json», «keys», «tools»).
+        """
+        if not getattr(response, 'choices', None):
+            return 'error'
+        message = response.choices[0].message
+        tool_calls = getattr(message, 'tool_calls', None)
+        if tool_calls:
+            # вызовы инструментов: ответ будет получен после их выполнения
+            try:
+                if all(isinstance(json.loads(call.function.arguments or '{}'), dict) for call in tool_calls):
+                    return None
+            except (AttributeError, TypeError, ValueError):
+                pass
+            return 'tools'
+        try:
+            data = json.loads(message.content.strip())
+        except (AttributeError, TypeError, ValueError):
+            return 'json'
+        if not isinstance(data, dict) or any(key not in data for key in self.REQUIRED_KEYS):
+            return 'keys'
+        return None
+
+    def prices(self, model: str = None):
+        """
+        Цены (за 1 млн токенов) входа и выхода для модели.
+        """
+        if model and model == self.fast and model != self.strong:
+            return self.main.env.get_float('GPT_FAST_PRICE_IN'), self.main.env.get_float('GPT_FAST_PRICE_OUT')
+        return self.main.env.get_float('GPT_PRICE_IN'), self.main.env.get_float('GPT_PRICE_OUT')
+
+    def stats(self) -> dict:
+        return {'routed': dict(self.routed), 'escalations': self.escalations}
@@ -0,0 +1,11 @@
+# telegram/classes/stats.py
+# Общие функции статистики замеров
+
+def percentile(values, p: float) -> float:
+    """
+    Перцентиль `p` (0-100) по ближайшему рангу; для пустого набора - 0.0.
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
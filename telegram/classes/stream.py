@@ -0,0 +1,134 @@
+# telegram/classes/stream.py
+# Потоковая выдача ответа: разбор поля "answer" из JSON по мере генерации
+# и постепенное обновление сообщения в Телеграм
+
+import re
+import time
+from telegram.error import TelegramError
+
+class AnswerExtractor:
+    """
+    Инкрементальный разбор строкового поля JSON-ответа модели (по умолчанию "answer").
+    Получает фрагменты текста через `feed()` и возвращает уже раскодированную часть значения.
+    """
+
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, field: str = 'answer'):
+        self.pattern = re.compile(r'(?<!\\)"' + re.escape(field) + r'"\s*:\s*"')
+        self.buffer = ''
+        self.pos = None         # позиция следующего символа значения в buffer
+        self.value = ''
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """
+        Добавляет фрагмент ответа, возвращает текущее (возможно неполное) значение поля.
+        """
+        self.buffer += chunk
+        if self.done:
+            return self.value
+
+        if self.pos is None:
+            match = self.pattern.search(self.buffer)
+            if not match:
+                return self.value
+            self.pos = match.end()
+
+        parts = []
+        buffer, pos = self.buffer, self.pos
+        while pos < len(buffer):
+            char = buffer[pos]
+            if char == '"':
+                self.done = True
+                pos += 1
+                break
+            if char != '\\':
+                parts.append(char)
+                pos += 1
+                continue
+
+            # escape-последовательность: ждём, пока она придёт целиком
+            if pos + 1 >= len(buffer):
+                break
+            code = buffer[pos + 1]
+            if code == 'u':
+                if pos + 6 > len(buffer):
+                    break
+                try:
+                    unit = int(buffer[pos + 2:pos + 6], 16)
+                except ValueError:
+                    unit = 0xFFFD
+                if 0xD800 <= unit < 0xDC00:
+                    # старшая половина суррогатной пары: нужна вторая \uXXXX
+                    if pos + 12 > len(buffer):
+                        break
+                    try:
+                        low = int(buffer[pos + 8:pos + 12], 16)
+                    except ValueError:
+                        low = 0
+                    if buffer[pos + 6:pos + 8] == '\\u' and 0xDC00 <= low < 0xE000:
+                        parts.append(chr(0x10000 + ((unit - 0xD800) << 10) + (low - 0xDC00)))
+                        pos += 12
+                        continue
+                    unit = 0xFFFD
+                parts.append(chr(unit))
+                pos += 6
+            else:
+                parts.append(self.ESCAPES.get(code, code))
+                pos += 2
+
+        self.pos = pos
+        self.value += ''.join(parts)
+        return self.value
+
+class StreamMessage:
+    """
+    Сообщение Телеграм, которое дописывается по мере генерации ответа.
+    Первое обновление отправляет сообщение, следующие редактируют его не чаще,
+    чем раз в `interval` секунд (ограничения Телеграм на редактирование).
+    """
+
+    def __init__(self, main, update, interval: float = 1.0):
+        self.main = main
+        self.update = update
+        self.interval = interval
+        self.message = None
+        self.text = ''
+        self.last_edit = 0.0
+
+    async def push(self, text: str):
+        """
+        Показывает промежуточный текст (с учётом ограничения частоты).
+        """
+        text = text.strip()
+        if not text or text == self.text:
+            return
+        if self.message is not None and time.monotonic() - self.last_edit < self.interval:
+            return
+        await self._show(text)
+
+    async def finish(self, text: str):
+        """
+        Показывает окончательный текст ответа.
+        """
+        if self.message is None:
+            self.message = await self.update.message.reply_text(text)
+            self.text = text
+        elif text != self.text and not await self._show(text):
+            # не удалось отредактировать - отправляем ответ отдельным сообщением
+            self.message = await self.update.message.reply_text(text)
+            self.text = text
+
+    async def _show(self, text: str) -> bool:
+        self.last_edit = time.monotonic()
+        try:
+            if self.message is None:
+                self.message = await self.update.message.reply_text(text)
+            else:
+                await self.message.edit_text(text)
+            self.text = text
+            return True
+        except TelegramError as e:
+            await self.main.log.log_info('telegram', 'Ошибка обновления сообщения', str(e))
+            return False
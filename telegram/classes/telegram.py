@@ -47,18 +47,56 @@ class Telegram():
         # Обработка текстового сообщения
         await self.main.request.handle_message(update, context)
         
+    # МЕТОД: обработчик команды /stats (только в группе техподдержки)
+    async def stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.message.chat.id != int(self.main.env.get('SUPPORT_GROUP_ID')): return
+
+        # Статистика запросов к MySQL
+        text = '📊 MySQL:\n\n' + self.main.mysql.stats.report()
+
+        # Счётчики кэшей
+        text = '🗂 Кэши:\n' + '\n'.join(
+            f"{name}: {stats}" for name, stats in self.main.request.cache_stats().items()
+        ) + '\n\n' + text
+
+        # Индекс базы знаний: время загрузки и объём
+        text = f"📚 Индекс: {self.main.chunks.load_stats or 'не загружен'}\n\n" + text
+
+        # Вызовы OpenAI: предохранитель, повторы, дублирование запросов
+        text = f"🤖 OpenAI: {self.main.gpt.stats()}\n\n" + text
+        await update.message.reply_text(text[:4000])
+
     # МЕТОД: получение имени бота
     async def get_bot_name(self, app:Application) -> str:
         bot = app.bot
         me = await bot.get_me()
         return me.username              
+
+    # МЕТОД: подготовка при запуске бота (загрузка индекса базы знаний в фоне, проверка схемы БД)
+    async def post_init(self, app: Application):
+        self.main.chunks.start()
+
+        # схема БД: что из миграций уже применено (при ошибке проверка повторится при первой записи)
+        try:
+            await self.main.request.check_schema()
+        except Exception as e:
+            await self.main.log.log_info('mysql', 'Ошибка проверки схемы', str(e), True)
+
+    # МЕТОД: освобождение ресурсов при остановке бота
+    async def shutdown(self, app: Application):
+        await self.main.request.shutdown()
+        await self.main.reference.shutdown()
+        await self.main.chunks.shutdown()
+        await self.main.gpt.shutdown()
+        await self.main.mysql.shutdown()
                 
     def run(self):
         # создаем приложение
-        app = Application.builder().token(self.main.env.get('TELEGRAM_TOKEN')).build()
+        app = Application.builder().token(self.main.env.get('TELEGRAM_TOKEN')).post_init(self.post_init).post_shutdown(self.shutdown).build()
 
         # добавление обработчиков
         app.add_handler(CommandHandler('start', self.start, block=False))
+        app.add_handler(CommandHandler('stats', self.stats, block=False))
         app.add_handler(MessageHandler(filters.TEXT, self.text, block=False))
 
         # определение имени бота
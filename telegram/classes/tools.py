@@ -0,0 +1,81 @@
+# telegram/classes/tools.py
+# Функции записи на приём в формате инструментов OpenAI (tool calling)
+
+def tool(name: str, description: str, properties: dict) -> dict:
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": {
+                "type": "object",
+                "properties": properties,
+                "required": list(properties),
+                "additionalProperties": False
+            }
+        }
+    }
+
+def string(description: str) -> dict:
+    return {"type": "string", "description": description}
+
+# Описание функций для модели (client_id, update и context подставляются ботом)
+TOOLS = [
+    tool("write_recept", "Записать клиента на приём после подтверждения адреса, даты и времени.", {
+        "event_id": string("event_id выбранного времени приёма"),
+        "problem": string("Проблема, с которой обращается клиент"),
+        "client_fio": string("ФИО клиента полностью")
+    }),
+    tool("write_me_update", "Перенести запись клиента на другое время или адрес после подтверждения.", {
+        "event_id": string("event_id нового времени приёма")
+    }),
+    tool("write_me_cancel", "Отменить запись клиента после подтверждения.", {
+        "event_id": string("event_id отменяемой записи")
+    }),
+    tool("write_recept_friend", "Записать друга, родственника или знакомого клиента на приём.", {
+        "friend_event_id": string("event_id выбранного времени приёма"),
+        "friend_problem": string("Проблема, с которой обращается друг"),
+        "friend_fio": string("ФИО друга полностью"),
+        "friend_name": string("Кем приходится клиенту: «мама», «сын», «друг», «знакомая» и т.п.")
+    }),
+    tool("write_friend_update", "Перенести запись друга, родственника или знакомого на другое время.", {
+        "friend_write_id": string("id записи друга"),
+        "friend_event_id": string("event_id нового времени приёма")
+    }),
+    tool("write_friend_cancel", "Отменить запись друга, родственника или знакомого.", {
+        "friend_write_id": string("id записи друга")
+    }),
+    tool("notify_operator", "Передать обращение клиента в чат поддержки (оператору).", {
+        "message": string("Суть обращения для оператора")
+    })
+]
+
+# Дополнение к ответу после успешного вызова функции
+REPLIES = {
+    "write_recept": "✅ Вы записаны!",
+    "write_me_update": "🔄 Запись перенесена!",
+    "write_me_cancel": "🚫 Запись отменена!",
+    "write_recept_friend": "✅ Запись выполнена!",
+    "write_friend_update": "🔄 Запись перенесена!",
+    "write_friend_cancel": "🚫 Запись отменена!",
+    "notify_operator": "👨‍⚕️ Ваше обращение направлено в чат поддержки! Вам ответит первый освободившийся оператор"
+}
+
+# Функции, после которых диалог очищается (запись изменена)
+CLEAR_DIALOG = {
+    "write_recept", "write_me_update", "write_me_cancel",
+    "write_recept_friend", "write_friend_update", "write_friend_cancel"
+}
+
+def call_key(name: str, args: dict):
+    """
+    Ресурс, который изменяет вызов: вызовы с одинаковым ключом выполняются по порядку,
+    с разными - параллельно.
+    """
+    if name in ("write_recept", "write_me_update", "write_me_cancel"):
+        return "me"
+    if name in ("write_friend_update", "write_friend_cancel"):
+        return ("friend", str(args.get("friend_write_id")))
+    if name == "write_recept_friend":
+        return ("friend_new", str(args.get("friend_fio")))
+    return name
@@ -5,6 +5,7 @@
 from classes.env import Env             # класс для работы с переменными окружения
 from classes.log import Log             # класс для работы с журналом
 from classes.mysql import MySQL         # класс для работы с MySQL
+from classes.reference import Reference # класс для кэша справочников
 from classes.chunks import Chunks       # класс для поиска релевантных чанков
 from classes.gpt import Gpt             # класс для работы с GPT
 from classes.google import Google       # класс для работы с Google
@@ -21,6 +22,7 @@ class Main:
         self.env = Env()                # объект класса для работы с переменными окружения
         self.log = Log()                # объект класса для работы с журналом
         self.mysql = MySQL(self)        # объект класса для работы с MySQL
+        self.reference = Reference(self) # объект класса для кэша справочников
         self.chunks = Chunks(self)      # объект класса для поиска релевантных чанков
         self.gpt = Gpt(self)            # объект класса для работы с GPT
         self.google = Google(self)      # объект класса для работы с Google
@@ -0,0 +1,7 @@
+# telegram/tests/conftest.py
+# Тесты запускаются из каталога telegram: python -m pytest tests
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
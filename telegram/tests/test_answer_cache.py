@@ -0,0 +1,140 @@
+# telegram/tests/test_answer_cache.py
+# Кэш ответов в обычном сценарии: /start → вопрос → тот же вопрос повторно
+
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('telegram')
+
+from classes.request import Request
+from classes.telegram import Telegram
+
+class Env:
+    def __init__(self, **values):
+        self.values = values
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def get_int(self, key, default=0):
+        value = self.values.get(key)
+        return int(value) if value is not None else default
+
+    def get_float(self, key, default=0.0):
+        value = self.values.get(key)
+        return float(value) if value is not None else default
+
+class Log:
+    async def log_info(self, *args, **kwargs):
+        pass
+
+class MySQL:
+    """
+    Таблицы rec_dialog и rec_client одного клиента в памяти.
+    """
+
+    def __init__(self):
+        self.dialog = []        # [role, content, is_delete]
+        self.summary = None
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield self
+
+    async def has_unique_key(self, table, column):
+        return True
+
+    async def has_column(self, table, column):
+        return True
+
+    async def execute_return_id(self, sql, params=None):
+        return 1
+
+    async def execute(self, sql, params=None):
+        if 'INSERT INTO rec_dialog' in sql:
+            self.dialog.append([params[1], params[2], 0])
+        elif 'UPDATE `rec_dialog` SET `is_delete`=1' in sql:
+            for row in self.dialog:
+                row[2] = 1
+        elif 'SET summary = NULL' in sql:
+            self.summary = None
+        elif 'SET summary' in sql:
+            self.summary = params[0]
+
+    async def fetch_one(self, sql, params=None):
+        if 'SELECT summary' in sql:
+            return (self.summary,)
+        if 'COUNT(*) FROM rec_dialog' in sql:
+            return (sum(1 for role, _, is_delete in self.dialog if role == 0 and not is_delete),)
+        return None
+
+    async def fetch_all(self, sql, params=None):
+        if 'FROM rec_dialog' in sql:
+            rows = [(role, content) for role, content, is_delete in self.dialog if not is_delete]
+            return rows[::-1][:params[1]]
+        return []
+
+class Chunks:
+    index_path = '/nonexistent'
+
+    async def embed_query(self, text):
+        return [1.0, 0.0, 0.0]
+
+    async def find_local_list(self, question, vector=None):
+        return []
+
+class Gpt:
+    def __init__(self):
+        self.calls = 0
+
+    async def request(self, **kwargs):
+        self.calls += 1
+        content = json.dumps({'answer': 'Мы находимся в Москве и Санкт-Петербурге.', 'summary': 'Спросил адрес'})
+        message = SimpleNamespace(content=content, tool_calls=None)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=None)
+
+class Google:
+    async def row_insert(self, data):
+        pass
+
+class Main:
+    def __init__(self):
+        self.env = Env(ANSWER_CACHE=1, GPT_MODEL='gpt-4o-mini', SUPPORT_GROUP_ID='-100', DIALOG_SAVE='5')
+        self.log = Log()
+        self.mysql = MySQL()
+        self.chunks = Chunks()
+        self.gpt = Gpt()
+        self.google = Google()
+        self.reference = SimpleNamespace(stamp=None, day=None)
+        self.request = Request(self)
+
+def make_update(text, replies):
+    async def reply_text(answer):
+        replies.append(answer)
+
+    user = SimpleNamespace(id=42, username='client', full_name='Клиент', first_name='Клиент', last_name=None)
+    message = SimpleNamespace(chat=SimpleNamespace(id=42), text=text, from_user=user, reply_text=reply_text)
+    return SimpleNamespace(effective_user=user, message=message)
+
+def test_repeat_question_after_start_is_answered_from_cache():
+    async def run():
+        main = Main()
+        bot = Telegram.__new__(Telegram)
+        bot.main = main
+        replies = []
+
+        await bot.start(make_update('/start', replies), None)
+        question = 'Где находится ваш медицинский центр?'
+        await bot.text(make_update(question, replies), None)
+        await bot.text(make_update(question, replies), None)
+        return main, replies
+
+    main, replies = asyncio.run(run())
+    assert main.gpt.calls == 1
+    assert replies[1] == replies[2] == 'Мы находимся в Москве и Санкт-Петербурге.'
+    assert main.request.answers.entries.hits == 1
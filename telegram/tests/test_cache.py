@@ -0,0 +1,27 @@
+# telegram/tests/test_cache.py
+# LRUCache: вытеснение по объёму при изменении записи на месте
+
+from classes.cache import LRUCache
+
+def test_update_evicts_when_entry_grows_over_maxbytes():
+    cache = LRUCache(maxsize=10, maxbytes=100, sizeof=len)
+    cache.set('old', [0] * 40)
+    cache.set('new', [0] * 40)
+
+    cache.peek('new').extend([0] * 461)
+    cache.update('new')
+
+    assert cache.bytes <= 100
+    assert 'old' not in cache
+    assert cache.evictions >= 1
+
+def test_update_keeps_entries_within_maxbytes():
+    cache = LRUCache(maxsize=10, maxbytes=100, sizeof=len)
+    cache.set('a', [0] * 40)
+    cache.set('b', [0] * 40)
+
+    cache.peek('b').append(0)
+    cache.update('b')
+
+    assert cache.keys() == ['a', 'b']
+    assert cache.bytes == 81
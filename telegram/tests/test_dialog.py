@@ -0,0 +1,85 @@
+# telegram/tests/test_dialog.py
+# DialogWriter: порядок записи и согласованное чтение во время сброса
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from classes.dialog import DialogWriter
+
+class Env:
+    def get_int(self, key, default=0):
+        return default
+
+    def get_float(self, key, default=0.0):
+        return default
+
+class Log:
+    async def log_info(self, *args, **kwargs):
+        pass
+
+class SlowMySQL:
+    """
+    Строки видны другим соединениям сразу после отправки запроса (autocommit),
+    а ответ сервера приходит через `delay` секунд.
+    """
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.rows = []
+        self.statements = []
+
+    @asynccontextmanager
+    async def transaction(self):
+        yield self
+
+    async def executemany(self, sql, seq_params):
+        self.statements.append(' '.join(sql.split()))
+        self.rows += [(params[0], params[1], params[2]) for params in seq_params]
+        await asyncio.sleep(self.delay)
+        return len(seq_params)
+
+    async def select(self, client_id):
+        await asyncio.sleep(0)
+        return [row for row in self.rows if row[0] == client_id]
+
+class Main:
+    def __init__(self, delay: float = 0.05):
+        self.env = Env()
+        self.log = Log()
+        self.mysql = SlowMySQL(delay)
+
+def test_read_during_slow_flush_has_no_duplicates():
+    async def run():
+        main = Main()
+        writer = DialogWriter(main)
+        await writer.add(1, 0, 'вопрос')
+        await writer.add(1, 1, 'ответ')
+
+        flush = asyncio.create_task(writer.flush())
+        await asyncio.sleep(0.01)
+        # часть строк уже в БД, а сброс ещё не завершён
+        assert main.mysql.rows and not flush.done()
+
+        result, pending = await writer.read(1, lambda: main.mysql.select(1))
+        await flush
+        await writer.shutdown()
+        return result, pending
+
+    result, pending = asyncio.run(run())
+    contents = [row[2] for row in result] + [row['content'] for row in pending]
+    assert contents == ['вопрос', 'ответ']
+
+def test_flush_keeps_buffer_order_with_fixed_statements():
+    async def run():
+        main = Main(delay=0)
+        writer = DialogWriter(main)
+        for role, content in [(0, 'в1'), (1, 'о1'), (0, 'в2'), (0, 'в3'), (1, 'о2')]:
+            await writer.add(7, role, content)
+        await writer.flush()
+        await writer.shutdown()
+        return main.mysql
+
+    mysql = asyncio.run(run())
+    assert [row[2] for row in mysql.rows] == ['в1', 'о1', 'в2', 'в3', 'о2']
+    # по одной форме запроса на роль, независимо от размера пачки
+    assert len(set(mysql.statements)) == 2